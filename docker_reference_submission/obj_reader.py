@@ -0,0 +1,172 @@
+"""
+Lightweight .obj reader
+
+Only the `v` and `f` lines of the file are parsed, straight into NumPy arrays,
+instead of building a full trimesh.Trimesh (normals, materials, ...). Vertices
+are returned in file order, like trimesh.load(scan_path, process=False) does
+for scans without texture coordinates, so vertex indices are unchanged. Unlike
+trimesh, vertices that no face uses are kept.
+
+Parsed arrays can be kept in a cache directory as .npy files keyed by the
+path, size and modification time of the scan, so that running again on the
+same scans skips parsing. /input is read-only in the container: the cache
+goes to its own directory, e.g. a mounted volume.
+"""
+import collections
+import glob
+import hashlib
+import os
+import tempfile
+import warnings
+
+import numpy as np
+
+Mesh = collections.namedtuple("Mesh", ["vertices", "faces"])
+
+
+def _parse_numbers(text, dtype, count):
+    """1-D array of the `count` whitespace separated numbers of a bytes string, None if it holds anything else"""
+    try:
+        with warnings.catch_warnings():
+            # NumPy < 2 stops at the first token it cannot parse and warns, NumPy >= 2 raises
+            warnings.simplefilter("ignore", DeprecationWarning)
+            values = np.fromstring(text, dtype=dtype, sep=" ")
+    except ValueError:
+        return None
+    return values if len(values) == count else None
+
+
+# whitespace bytes, as split() sees them
+_SEPARATORS = np.zeros(256, dtype=bool)
+_SEPARATORS[list(b" \t\n\r\v\f")] = True
+
+
+def _line_counts(lines):
+    """Number of whitespace separated tokens, and of "/", on each of `lines`"""
+    data = np.frombuffer(b"\n".join(lines) + b"\n", dtype=np.uint8)
+    starts = np.zeros(len(lines), dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, lines), dtype=np.int64, count=len(lines))[:-1] + 1, out=starts[1:])
+    separator = _SEPARATORS[data]
+    token_start = ~separator
+    token_start[1:] &= separator[:-1]
+    tokens = np.bincount(np.searchsorted(starts, np.flatnonzero(token_start), side="right") - 1,
+                         minlength=len(lines))
+    slashes = np.bincount(np.searchsorted(starts, np.flatnonzero(data == ord("/")), side="right") - 1,
+                          minlength=len(lines))
+    return tokens, slashes
+
+
+def _parse_faces(face_lines, nb_vertices):
+    """(F, 3) int64 zero-based triangles of `f` lines, polygons are triangulated"""
+    if not face_lines:
+        return np.empty((0, 3), dtype=np.int64)
+    # face vertices are v, v/vt, v//vn or v/vt/vn: keep v
+    first = face_lines[0].split()[0]
+    nb_fields = first.count(b"/") + 1
+    tokens, slashes = _line_counts(face_lines)
+    indices = None
+    # triangles only, every line with the same vertex format
+    if (tokens == 3).all() and (slashes == 3 * (nb_fields - 1)).all():
+        indices = _parse_numbers(b" ".join(face_lines).replace(b"//", b"/0/").replace(b"/", b" "), np.int64,
+                                 3 * nb_fields * len(face_lines))
+    if indices is not None:
+        faces = indices[::nb_fields].reshape(-1, 3)
+    else:
+        # polygons, or a mix of face vertex formats
+        triangles = []
+        for line in face_lines:
+            polygon = [int(token.split(b"/")[0]) for token in line.split()]
+            if len(polygon) == 4:
+                # split like trimesh does
+                triangles.extend([polygon[:3], [polygon[2], polygon[3], polygon[0]]])
+            else:
+                triangles.extend([polygon[0], polygon[i], polygon[i + 1]] for i in range(1, len(polygon) - 1))
+        faces = np.array(triangles, dtype=np.int64).reshape(-1, 3)
+    # obj indices are one-based, negative ones count back from the last vertex
+    return np.where(faces < 0, faces + nb_vertices, faces - 1)
+
+
+def parse_obj(scan_path):
+    """
+    Parse the vertices and faces of an .obj file
+    Input:
+        scan_path: path of the .obj file
+    Output:
+        Mesh with (V, 3) float64 vertices and (F, 3) int64 zero-based faces
+    """
+    with open(scan_path, "rb") as fp:
+        lines = fp.read().splitlines()
+    vertex_lines = []
+    face_lines = []
+    for line in lines:
+        # keyword and values may be separated, and preceded, by any whitespace
+        fields = line.split(None, 1)
+        if len(fields) < 2:
+            continue
+        if fields[0] == b"v":
+            vertex_lines.append(fields[1])
+        elif fields[0] == b"f":
+            face_lines.append(fields[1])
+
+    coords = None
+    if vertex_lines:
+        tokens, _ = _line_counts(vertex_lines)
+        width = tokens[0]
+        # x y z, possibly followed by vertex colors, on every line
+        if width >= 3 and (tokens == width).all():
+            coords = _parse_numbers(b" ".join(vertex_lines), np.float64, width * len(vertex_lines))
+    if coords is not None:
+        vertices = coords.reshape(len(vertex_lines), -1)[:, :3]
+    else:
+        vertices = np.array([line.split()[:3] for line in vertex_lines], dtype=np.float64).reshape(-1, 3)
+    vertices = np.ascontiguousarray(vertices)
+    return Mesh(vertices, _parse_faces(face_lines, len(vertices)))
+
+
+def _cache_prefix(scan_path, cache_dir):
+    path = os.path.realpath(scan_path)
+    scan_name = os.path.basename(path).split(".obj")[0]
+    return os.path.join(cache_dir, f"{scan_name}-{hashlib.sha1(path.encode()).hexdigest()[:16]}")
+
+
+def _save_npy(filename, array):
+    """np.save through a temporary file, so a concurrent reader never sees a partial file"""
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(filename), suffix=".tmp")
+    with os.fdopen(fd, "wb") as fp:
+        np.save(fp, array)
+    os.replace(tmp_path, filename)
+
+
+def read_obj(scan_path, cache_dir=None):
+    """
+    Read the vertices and faces of an .obj file, through the .npy cache in
+    cache_dir when one is given
+    Input:
+        scan_path: path of the .obj file
+        cache_dir: directory of cached arrays, None to always parse the file
+    Output:
+        Mesh with (V, 3) float64 vertices and (F, 3) int64 zero-based faces
+    """
+    if cache_dir is None:
+        return parse_obj(scan_path)
+
+    stat = os.stat(scan_path)
+    prefix = _cache_prefix(scan_path, cache_dir)
+    key = f"{prefix}-{stat.st_size}-{stat.st_mtime_ns}"
+    try:
+        return Mesh(np.load(key + ".vertices.npy"), np.load(key + ".faces.npy"))
+    except (OSError, ValueError):
+        pass
+
+    mesh = parse_obj(scan_path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # entries of older versions of the scan will never be read again
+        for stale in glob.glob(glob.escape(prefix) + "-*.npy"):
+            os.remove(stale)
+        _save_npy(key + ".faces.npy", mesh.faces)
+        # written last: its presence means the entry is complete
+        _save_npy(key + ".vertices.npy", mesh.vertices)
+    except OSError as e:
+        print(f"could not cache {scan_path}: {e}")
+    return mesh
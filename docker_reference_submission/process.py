@@ -1,13 +1,23 @@
+import collections
 import glob
+import io
+import itertools
 import json
+import os
 import random
-import trimesh
 import numpy as np
 import traceback
 import csv
 import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from obj_reader import read_obj
 
 LANDMARKS_CLASS = ["Mesial", "Distal", "Cusp", "InnerPoint", "OuterPoint", "FacialPoint"]
+# number of scans loaded ahead of the one being inferred
+PREFETCH_SCANS = 4
+# directory where parsed scans are cached between runs (/input is read-only), unset to disable
+MESH_CACHE_DIR = os.environ.get("MESH_CACHE_DIR")
 
 
 class NpEncoder(json.JSONEncoder):
@@ -21,6 +31,114 @@ class NpEncoder(json.JSONEncoder):
         return super(NpEncoder, self).default(obj)
 
 
+# landmarks predicted on one scan: N coordinates, classes and scores
+ScanLandmarks = collections.namedtuple("ScanLandmarks", ["key", "coords", "classes", "scores"])
+
+
+def _csv_text(values):
+    """CSV fields of an array, formatted like csv.writer formats them"""
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        # shortest repr of each float, like str() of a numpy float
+        return values.astype(str)
+    out = io.StringIO()
+    csv.writer(out, lineterminator='\n').writerows([value] for value in values.tolist())
+    return np.array(out.getvalue().split('\n')[:-1], dtype=object)
+
+
+class PredictionWriter:
+    """
+    Append the landmarks of each scan to a predictions CSV file as they come
+
+    Rows are written to a temporary file next to the CSV file, flushed after
+    every scan, and the file is renamed to its final name on close, so the CSV
+    file is either absent or complete.
+
+    Every scan written is then recorded in a progress manifest, with the size
+    of the temporary file at that point. With resume=True, a writer picks up
+    the temporary file of an interrupted run: rows past the last recorded scan
+    are dropped and `done` holds the keys of the scans that need not be
+    predicted again.
+    """
+    fieldnames = ['key', 'coord_x', 'coord_y', 'coord_z', 'class', 'score']
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.tmp_filename = filename + '.tmp'
+        self.manifest_filename = filename + '.progress'
+        self.done = []
+        size, manifest_size = self._read_manifest() if resume else (None, 0)
+        if size is None:
+            self.file = open(self.tmp_filename, mode='wb')
+            self.file.write((','.join(self.fieldnames) + '\n').encode())
+            self.manifest = open(self.manifest_filename, mode='w')
+        else:
+            self.file = open(self.tmp_filename, mode='r+b')
+            self.file.truncate(size)
+            self.file.seek(size)
+            # drop a partly written entry, new entries start on their own line
+            self.manifest = open(self.manifest_filename, mode='r+')
+            self.manifest.truncate(manifest_size)
+            self.manifest.seek(manifest_size)
+        self.file.flush()
+
+    def _read_manifest(self):
+        """Fill done from the manifest, returns the size of the rows of the done
+        scans and the size of their entries in the manifest, or (None, 0)"""
+        try:
+            with open(self.manifest_filename, 'rb') as fp:
+                lines = fp.readlines()
+            tmp_size = os.path.getsize(self.tmp_filename)
+        except OSError:
+            return None, 0
+        size = None
+        manifest_size = 0
+        for line in lines:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # the run was interrupted while recording this scan
+                break
+            if not line.endswith(b'\n') or entry['size'] > tmp_size:
+                break
+            self.done.append(entry['key'])
+            size = entry['size']
+            manifest_size += len(line)
+        return size, manifest_size
+
+    def write(self, scan_landmarks):
+        coords = np.asarray(scan_landmarks.coords).reshape(-1, 3)
+        key = _csv_text([scan_landmarks.key])[0]
+        columns = [np.full(len(coords), key, dtype=object),
+                   _csv_text(coords[:, 0]), _csv_text(coords[:, 1]), _csv_text(coords[:, 2]),
+                   _csv_text(scan_landmarks.classes), _csv_text(scan_landmarks.scores)]
+        if any(len(column) != len(coords) for column in columns):
+            raise ValueError(f"{scan_landmarks.key}: coords, classes and scores should have the same length")
+        self.file.write(''.join(','.join(row) + '\n' for row in zip(*columns)).encode())
+        self.file.flush()
+        # recorded once its rows are in the file
+        self.manifest.write(json.dumps({'key': scan_landmarks.key, 'size': self.file.tell()}) + '\n')
+        self.manifest.flush()
+        self.done.append(scan_landmarks.key)
+
+    def close(self):
+        self.file.close()
+        self.manifest.close()
+        os.replace(self.tmp_filename, self.filename)
+        os.remove(self.manifest_filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the rows written so far and the manifest to resume from
+            self.file.close()
+            self.manifest.close()
+
+
 class LandmarkDet:  # LandmarkDetectionAlgorithm is not inherited in this class anymore
     def __init__(self):
         """
@@ -44,85 +162,98 @@ class LandmarkDet:  # LandmarkDetectionAlgorithm is not inherited in this class
         return inputs
 
     @staticmethod
-    def write_output(predictions_list, output_dir="/output"):
+    def scan_name(scan_path):
+        return scan_path.split('/')[-1].split('.obj')[0]
+
+    @staticmethod
+    def write_output(scans_predicted, output_dir="/output"):
         """
-        #TODO add document here
+        Write the landmarks of every scan to predictions.csv as they are predicted
         """
-        # with open(f'{output_dir}/predictions.json', 'w') as fp:
-        #     json.dump(predictions_list, fp, cls=NpEncoder)
-        # Writing the list of dictionaries to a CSV file
-        with open(f'{output_dir}/predictions.csv', mode='w', newline='') as file:
-            fieldnames = ['key', 'coord_x', 'coord_y', 'coord_z', 'class', 'score']
-            writer = csv.DictWriter(file, fieldnames=fieldnames)
-
-            # Write the header
-            writer.writeheader()
-
-            # Write the data
-            for sublist in predictions_list:
-                for landmark in sublist:
-                    # Flatten the coord list for CSV
-                    coord_x, coord_y, coord_z = landmark['coord']
-                    row = {
-                        'key': landmark['key'],
-                        'coord_x': coord_x,
-                        'coord_y': coord_y,
-                        'coord_z': coord_z,
-                        'class': landmark['class'],
-                        'score': landmark['score']
-                    }
-                    writer.writerow(row)
+        with PredictionWriter(f'{output_dir}/predictions.csv') as writer:
+            for scan_landmarks in scans_predicted:
+                writer.write(scan_landmarks)
         return
 
+    @staticmethod
+    def load_mesh(scan_path):
+        """
+        Read an input 3D scan .obj
+        """
+        print(f"loading scan : {scan_path}")
+        try:
+            # only vertices and faces are parsed, in the same order as
+            # trimesh.load(scan_path, process=False); use trimesh or any other
+            # loader instead if you need normals, texture etc.
+            return read_obj(scan_path, cache_dir=MESH_CACHE_DIR)
+        except Exception as e:
+            print(str(e))
+            print(traceback.format_exc())
+            raise
+
+    def iter_meshes(self, inputs, prefetch=PREFETCH_SCANS, workers=None):
+        """
+        Yield (scan_path, mesh) in the order of inputs, loading up to `prefetch`
+        scans ahead in a thread pool so that the model does not wait for I/O
+        and OBJ parsing. At most prefetch + 1 meshes are held in memory.
+        """
+        workers = workers or min(prefetch, os.cpu_count() or 1)
+        paths = iter(inputs)
+        pending = collections.deque()
+        with ThreadPoolExecutor(max_workers=max(workers, 1)) as pool:
+            try:
+                for scan_path in itertools.islice(paths, max(prefetch, 1)):
+                    pending.append((scan_path, pool.submit(self.load_mesh, scan_path)))
+                while pending:
+                    scan_path, future = pending.popleft()
+                    # keep the queue full before handing the scan over
+                    for next_path in itertools.islice(paths, 1):
+                        pending.append((next_path, pool.submit(self.load_mesh, next_path)))
+                    yield scan_path, future.result()
+            finally:
+                # stop loading scans nobody will ask for (error or early exit)
+                for _, future in pending:
+                    future.cancel()
+
     def predict(self, inputs):
         """
         Your algorithm goes here
+        Yields the ScanLandmarks of each scan as soon as it is inferred
         """
-        landmarks_predicted = []
-        for scan_path in inputs:
-            scan_name = scan_path.split('/')[-1].split('.obj')[0]
+        # scans are loaded in the background while the previous ones are inferred
+        for scan_path, mesh in self.iter_meshes(inputs):
+            scan_name = self.scan_name(scan_path)
 
-            print(f"loading scan : {scan_name}")
-            # read input 3D scan .obj
-            try:
-                # you can use trimesh or other any loader we keep the same order
-                mesh = trimesh.load(scan_path, process=False)
-            except Exception as e:
-                print(str(e))
-                print(traceback.format_exc())
-                raise
             # preprocessing if needed
             # prep_data = preprocess_function(mesh)
             # inference data here
             # landmarks = self.model(mesh)
 
-            # extract number of vertices from mesh
-            nb_vertices = mesh.vertices.shape[0]
-            landmarks_scan = [
-                {"key": scan_name,  # ensure that the key is the scan name
-                 "coord": mesh.vertices[0], #mesh.vertices[random.randint(0, nb_vertices)],  # xyz coordinate
-                 "class": LANDMARKS_CLASS[0],#random.choice(LANDMARKS_CLASS),  # ensure that the class should be in LANDMARKS_CLASS list
-                 "score": 1#random.random()  # a prediction likelihood between 0 and 1
-                 },
-                {"key": scan_name,
-                 "coord": mesh.vertices[1],  # mesh.vertices[random.randint(0, nb_vertices)],
-                 "class": LANDMARKS_CLASS[1],  # random.choice(LANDMARKS_CLASS),
-                 "score": 1  # random.random()
-                 },
-            # ....
-            ]
-
-            landmarks_predicted.append(landmarks_scan)
-
-        return landmarks_predicted
+            yield ScanLandmarks(
+                key=scan_name,  # ensure that the key is the scan name
+                # (N, 3) xyz coordinates, e.g. mesh.vertices[np.random.randint(0, len(mesh.vertices), N)]
+                coords=mesh.vertices[[0, 1]],
+                # ensure that the classes are in LANDMARKS_CLASS list, e.g. np.random.choice(LANDMARKS_CLASS, N)
+                classes=[LANDMARKS_CLASS[0], LANDMARKS_CLASS[1]],
+                # prediction likelihoods between 0 and 1, e.g. np.random.random(N)
+                scores=[1, 1],
+            )
 
     def process(self):
         """
         Read input from /input, process with your algorithm and write to /output
         """
         input = self.load_input(input_dir='/input')
-        landmarks_predicted = self.predict(input)
-        self.write_output(predictions_list=landmarks_predicted, output_dir='/output')
+        # predictions are written scan by scan, nothing is kept in memory, and
+        # a run that was interrupted (time limit, out of memory) resumes after
+        # the last scan it wrote
+        with PredictionWriter('/output/predictions.csv', resume=True) as writer:
+            done = set(writer.done)
+            todo = [scan_path for scan_path in input if self.scan_name(scan_path) not in done]
+            if done:
+                print(f"resuming: {len(input) - len(todo)} scans already processed")
+            for scan_landmarks in self.predict(todo):
+                writer.write(scan_landmarks)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+"""Benchmark the evaluation code on synthetic workloads.
+
+Generates a goldstandard and predictions shaped like the challenge data
+(scans, landmarks per class, predictions per scan and score distribution
+are all configurable), times eval_det_cls_map, score.score,
+calculate_metrics_per_scan and bootstrap_compare on them and reports
+throughput and peak memory. Results are written as JSON so that two runs
+can be compared with --compare to flag regressions.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import warnings
+
+import numpy as np
+import pandas as pd
+
+from metrics import DIST_THRESH_LIST, calculate_metrics_per_scan, eval_det_cls_map, load_predictions
+from rank import CATEGORIES, METRICS, bootstrap_compare
+from score import score
+
+SCORE_DISTRIBUTIONS = ["uniform", "beta", "tied"]
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser(description="Benchmark metrics.py, score.py and rank.py")
+    parser.add_argument("-o", "--output", type=str, default="benchmark.json", help="JSON file of the results")
+    parser.add_argument("--scans", type=int, default=100, help="number of scans")
+    parser.add_argument("--landmarks", type=int, default=10, help="mean number of gt landmarks per scan and class")
+    parser.add_argument("--predictions", type=int, default=200, help="number of predictions per scan")
+    parser.add_argument("--scores", choices=SCORE_DISTRIBUTIONS, default="uniform",
+                        help="distribution of the prediction scores, 'tied' has 5 distinct values")
+    parser.add_argument("--teams", type=int, default=20, help="number of teams ranked by bootstrap_compare")
+    parser.add_argument("--bootstraps", type=int, default=100, help="bootstrap iterations of bootstrap_compare")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs of every benchmark, the median is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--only", type=str, nargs="+", default=None, help="names of the benchmarks to run")
+    parser.add_argument("--compare", type=str, nargs=2, metavar=("BASELINE", "NEW"), default=None,
+                        help="compare two result files instead of running the benchmarks")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="relative slowdown or memory increase reported as a regression by --compare")
+    return parser.parse_args()
+
+
+def make_workload(n_scans=100, landmarks=10, predictions=200, scores="uniform", seed=0):
+    """Synthetic goldstandard and predictions.
+
+    Every scan has a Poisson number of landmarks per class around
+    `landmarks` (at least one Cusp), spread over a 40 mm jaw. Its
+    `predictions` predictions are split evenly between the classes: 70%
+    are landmarks of that class moved by 1 mm of Gaussian noise, the others
+    random points of the jaw.
+
+    Input:
+        scores: "uniform", "beta" (mostly confident predictions) or "tied"
+        (5 distinct values, which exercises tie handling)
+    Output:
+        gt_all: map of {classname: {meshname: (n, 3) array}}
+        pred_submission: predictions DataFrame, rows shuffled
+    """
+    rng = np.random.default_rng(seed)
+    gt_all = {category: {} for category in CATEGORIES}
+    keys, coords, classes = [], [], []
+    per_class = max(predictions // len(CATEGORIES), 0)
+    for scan in range(n_scans):
+        scan_name = f"{scan:08d}_lower" if scan % 2 else f"{scan:08d}_upper"
+        for category in CATEGORIES:
+            n_kp = rng.poisson(landmarks)
+            if category == "Cusp":
+                n_kp = max(n_kp, 1)
+            kp = rng.uniform(-20, 20, size=(n_kp, 3))
+            gt_all[category][scan_name] = kp
+            near = rng.random(per_class) < 0.7 if n_kp else np.zeros(per_class, dtype=bool)
+            pred = rng.uniform(-20, 20, size=(per_class, 3))
+            if n_kp:
+                pred[near] = kp[rng.integers(n_kp, size=near.sum())] + rng.normal(0, 1, size=(near.sum(), 3))
+            keys.append(np.full(per_class, scan_name))
+            coords.append(pred)
+            classes.append(np.full(per_class, category))
+    n_rows = per_class * len(CATEGORIES) * n_scans
+    if scores == "uniform":
+        score_values = rng.random(n_rows)
+    elif scores == "beta":
+        score_values = rng.beta(5, 1, n_rows)
+    else:
+        score_values = rng.integers(0, 5, n_rows) / 4
+    coords = np.concatenate(coords + [np.empty((0, 3))])
+    pred_submission = pd.DataFrame({
+        "key": np.concatenate(keys + [np.empty(0, dtype=str)]),
+        "coord_x": coords[:, 0], "coord_y": coords[:, 1], "coord_z": coords[:, 2],
+        "class": np.concatenate(classes + [np.empty(0, dtype=str)]),
+        "score": score_values,
+    })
+    pred_submission = pred_submission.iloc[rng.permutation(n_rows)].reset_index(drop=True)
+    return gt_all, pred_submission
+
+
+def make_team_metrics(n_teams, scan_names, seed=0):
+    """Per-scan metrics of `n_teams` synthetic teams of increasing skill, as
+    returned by calculate_metrics_per_scan for each team."""
+    rng = np.random.default_rng(seed)
+    metrics_dict = {}
+    for team in range(n_teams):
+        skill = 0.3 + 0.4 * team / max(n_teams - 1, 1)
+        values = np.clip(rng.normal(skill, 0.15, size=(len(scan_names), len(METRICS), len(CATEGORIES))), 0, 1)
+        metrics_dict[f"team_{team:03d}"] = {
+            scan_name: {metric: dict(zip(CATEGORIES, values[s, m].tolist())) for m, metric in enumerate(METRICS)}
+            for s, scan_name in enumerate(scan_names)
+        }
+    return metrics_dict
+
+
+def measure(function, repeat=3):
+    """Median and minimum wall time of `function` over `repeat` runs, and the
+    peak memory allocated during one more run traced by tracemalloc."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    # traced separately, tracemalloc slows allocations down
+    tracemalloc.start()
+    try:
+        function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {"seconds": float(np.median(times)), "min_seconds": float(np.min(times)), "peak_mb": peak / 1e6}
+
+
+def run_benchmarks(args):
+    """Results of every benchmark, {name: {seconds, min_seconds, peak_mb, throughput, unit}}."""
+    gt_all, pred_submission = make_workload(args.scans, args.landmarks, args.predictions, args.scores, args.seed)
+    pred_all_map = load_predictions(pred_submission)
+    scan_names = list(gt_all["Cusp"].keys())
+    n_preds = len(pred_submission)
+    n_cusp = sum(len(dets[1]) for dets in pred_all_map["Cusp"].values())
+    team_metrics = make_team_metrics(args.teams, scan_names, args.seed)
+    n_comparisons = args.teams * (args.teams - 1) // 2 * len(METRICS) * len(CATEGORIES) * args.bootstraps
+
+    # name: (function, amount of work, unit of the throughput)
+    benchmarks = {
+        "load_predictions": (lambda: load_predictions(pred_submission), n_preds, "predictions/s"),
+        "eval_det_cls_map": (lambda: eval_det_cls_map(pred_all_map["Cusp"], gt_all["Cusp"], 0.1, "Cusp"),
+                             n_cusp, "predictions/s"),
+        "score": (lambda: score(gt_all, pred_all_map), n_preds * len(DIST_THRESH_LIST), "predictions x thresholds/s"),
+        "calculate_metrics_per_scan": (lambda: calculate_metrics_per_scan(pred_all_map, gt_all), len(scan_names),
+                                       "scans/s"),
+        "bootstrap_compare": (lambda: bootstrap_compare(team_metrics, scan_names, n_bootstraps=args.bootstraps,
+                                                        seed=args.seed), n_comparisons, "tests/s"),
+    }
+    results = {}
+    for name, (function, work, unit) in benchmarks.items():
+        if args.only and name not in args.only:
+            continue
+        result = measure(function, args.repeat)
+        result["throughput"] = work / result["seconds"] if result["seconds"] > 0 else float("inf")
+        result["unit"] = unit
+        results[name] = result
+        print(f"{name:<28} {result['seconds']:9.4f} s  {result['throughput']:14.1f} {unit:<28}"
+              f"{result['peak_mb']:9.1f} MB")
+    return results
+
+
+def compare(baseline, new, tolerance=0.1):
+    """Regressions of `new` against `baseline` result files, as messages."""
+    if baseline["params"] != new["params"]:
+        print("warning: the runs used different workloads:", baseline["params"], new["params"])
+    regressions = []
+    print(f"{'benchmark':<28} {'baseline s':>10} {'new s':>10} {'ratio':>7} {'baseline MB':>12} {'new MB':>9}")
+    for name, base in baseline["results"].items():
+        if name not in new["results"]:
+            continue
+        result = new["results"][name]
+        ratio = result["seconds"] / base["seconds"] if base["seconds"] > 0 else float("inf")
+        print(f"{name:<28} {base['seconds']:10.4f} {result['seconds']:10.4f} {ratio:7.2f} "
+              f"{base['peak_mb']:12.1f} {result['peak_mb']:9.1f}")
+        if ratio > 1 + tolerance:
+            regressions.append(f"{name} is {ratio:.2f}x slower")
+        if result["peak_mb"] > base["peak_mb"] * (1 + tolerance):
+            regressions.append(f"{name} peak memory grew from {base['peak_mb']:.1f} to {result['peak_mb']:.1f} MB")
+    return regressions
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    if args.compare:
+        with open(args.compare[0]) as fp:
+            baseline = json.load(fp)
+        with open(args.compare[1]) as fp:
+            new = json.load(fp)
+        regressions = compare(baseline, new, args.tolerance)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        sys.exit(1 if regressions else 0)
+
+    params = {name: getattr(args, name)
+              for name in ["scans", "landmarks", "predictions", "scores", "teams", "bootstraps", "seed"]}
+    # scans without a landmark of a class divide by zero, like real ones
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)
+        results = run_benchmarks(args)
+    with open(args.output, "w") as out:
+        json.dump({"params": params,
+                   "environment": {"python": platform.python_version(), "numpy": np.__version__,
+                                   "pandas": pd.__version__, "machine": platform.machine(),
+                                   "processor": platform.processor()},
+                   "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                   "results": results}, out, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""Array-backed goldstandard file.
+
+The goldstandard {class: {scan: [kp]}} map is stored as an uncompressed
+.npz holding one flat (M, 3) float64 `coords` array and an index of
+(class, scan, offset) entries. The coordinates are memory-mapped when the
+file is loaded, each scan getting a view of its slice, so nothing is
+copied or unpickled.
+"""
+
+import argparse
+import pickle
+import struct
+import zipfile
+
+import numpy as np
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser(description="Convert a pickled goldstandard to .npz")
+    parser.add_argument("-i", "--input", type=str, required=True, help="goldstandard pickle file")
+    parser.add_argument("-o", "--output", type=str, required=True, help="output .npz file")
+    return parser.parse_args()
+
+
+def save_goldstandard(gt_all, filename):
+    """Write a {class: {scan: [kp]}} map to an array-backed .npz file."""
+    classes, scans, counts, coords = [], [], [], []
+    for class_name, scans_kp in gt_all.items():
+        for scan_name, keypoints in scans_kp.items():
+            if not isinstance(class_name, str) or not isinstance(scan_name, str):
+                raise TypeError(f"Class and scan names must be strings, got {class_name!r}, {scan_name!r}")
+            keypoints = np.asarray(keypoints, dtype=np.float64).reshape(-1, 3)
+            classes.append(class_name)
+            scans.append(scan_name)
+            counts.append(len(keypoints))
+            coords.append(keypoints)
+    offsets = np.concatenate(([0], np.cumsum(counts, dtype=np.int64)))
+    # stored uncompressed so that coords can be memory-mapped
+    np.savez(filename,
+             coords=np.concatenate(coords + [np.empty((0, 3))]),
+             offsets=offsets,
+             class_names=np.array(list(gt_all.keys()), dtype=str),
+             classes=np.array(classes, dtype=str),
+             scans=np.array(scans, dtype=str))
+
+
+def _memmap_npz_member(filename, member):
+    """Memory-map an array stored uncompressed in a .npz archive."""
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError(f"{member} is compressed in {filename} and cannot be memory-mapped")
+    with open(filename, "rb") as fp:
+        # skip the zip local file header to reach the .npy payload
+        fp.seek(info.header_offset)
+        header = fp.read(30)
+        name_len, extra_len = struct.unpack("<HH", header[26:30])
+        fp.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(fp)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fp)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fp)
+        offset = fp.tell()
+    if not np.prod(shape):
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(filename, dtype=dtype, mode="r", offset=offset, shape=shape,
+                     order="F" if fortran_order else "C")
+
+
+def load_goldstandard(filename):
+    """Load a goldstandard {class: {scan: kp}} map.
+
+    .npz files written by save_goldstandard are memory-mapped and every
+    scan maps to a read-only (n, 3) view; any other file is read as the
+    legacy pickle.
+    """
+    if not filename.endswith(".npz"):
+        with open(filename, "rb") as fp:
+            return pickle.load(fp)
+
+    with np.load(filename, allow_pickle=False) as index:
+        class_names = index["class_names"]
+        offsets = index["offsets"]
+        classes = index["classes"]
+        scans = index["scans"]
+    coords = _memmap_npz_member(filename, "coords.npy")
+    gt_all = {class_name: {} for class_name in class_names.tolist()}
+    for class_name, scan_name, start, end in zip(classes.tolist(), scans.tolist(), offsets[:-1], offsets[1:]):
+        gt_all[class_name][scan_name] = coords[start:end]
+    return gt_all
+
+
+def load_goldstandard_index(filename):
+    """Number of gt keypoints of every (scan, class) of a goldstandard file.
+
+    Only the small (class, scan) index of an .npz file is read, the
+    coordinates are not touched; a legacy pickle has to be loaded whole.
+    """
+    if not filename.endswith(".npz"):
+        gt_all = load_goldstandard(filename)
+        return {(scan_name, class_name): len(np.asarray(keypoints))
+                for class_name, scans_kp in gt_all.items() for scan_name, keypoints in scans_kp.items()}
+
+    with np.load(filename, allow_pickle=False) as index:
+        offsets = index["offsets"]
+        classes = index["classes"]
+        scans = index["scans"]
+    return dict(zip(zip(scans.tolist(), classes.tolist()), np.diff(offsets).tolist()))
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    with open(args.input, "rb") as fp:
+        gold = pickle.load(fp)
+    save_goldstandard(gold, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Score a predictions file while it is being written.
+
+The reference submission appends the predictions of every scan to
+predictions.csv.tmp as soon as they are inferred and renames it to
+predictions.csv once all scans are done. This script follows that file and
+matches the predictions of every (scan, class) as they arrive: detections
+are sorted stably by confidence and only match keypoints of their own scan,
+so the matches of a (scan, class) do not depend on the other scans (see
+metrics.match_detections). Finalizing the scores is then a merge of the
+per-(scan, class) matches by confidence plus the precision/recall
+integration, and the results are identical to score.py on the final file.
+
+Containers that write predictions.csv in place are followed too, but the
+file is only known to be complete once the pipeline signals that the
+container exited (--done_file).
+"""
+
+import argparse
+import io
+import json
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from goldstandard import load_goldstandard
+from metrics import DIST_THRESH_LIST, calculate_metrics_per_scan, detection_arrays, match_detections
+from score import reformat_scores, score
+
+# parsed like the columns read by score.py, keys kept as strings whatever they look like
+CSV_DTYPES = {"key": str, "coord_x": np.float64, "coord_y": np.float64, "coord_z": np.float64,
+              "class": str, "score": np.float64}
+# seconds without new predictions after which following gives up
+FOLLOW_TIMEOUT = 3600.
+
+
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--predictions_file", type=str, required=True,
+                        help="final predictions file; with --follow, <file>.tmp is followed until it is renamed "
+                             "to <file>, or <file> itself until --done_file exists")
+    parser.add_argument("-g", "--goldstandard_file", type=str, required=True)
+    parser.add_argument("-o", "--output", type=str, default="results.json")
+    parser.add_argument("--per_scan_output", type=str, default=None,
+                        help="also write the mAP/mAR of every scan to this JSON file")
+    parser.add_argument("--follow", action="store_true",
+                        help="score the predictions while they are written")
+    parser.add_argument("--poll_interval", type=float, default=1., help="seconds between reads when following")
+    parser.add_argument("--timeout", type=float, default=FOLLOW_TIMEOUT,
+                        help="give up following after this many seconds without new predictions")
+    parser.add_argument("--done_file", type=str, default=None,
+                        help="file created once the writer has exited, e.g. after the container stopped; "
+                             "needed to know when a predictions file written in place is complete")
+    return parser.parse_args()
+
+
+class IncrementalScorer:
+    """Greedy matches of every (scan, class) of the predictions added so far."""
+
+    def __init__(self, gt_all, dist_thresh_list=DIST_THRESH_LIST):
+        self.gt_all = gt_all
+        self.dist_thresh_list = dist_thresh_list
+        # {classname: {meshname: (kp, score, sorted score, tp)}}, meshes in order of first appearance
+        # like the maps of metrics.load_predictions
+        self.meshes = {classname: {} for classname in gt_all.keys()}
+        self.n_predictions = 0
+
+    def reset(self):
+        """Forget every prediction, e.g. when the predictions file was truncated."""
+        self.meshes = {classname: {} for classname in self.gt_all.keys()}
+        self.n_predictions = 0
+
+    def _match(self, classname, mesh_name, kp, score):
+        gt = self.gt_all[classname]
+        mesh_gt = {mesh_name: gt[mesh_name]} if mesh_name in gt else {}
+        match = match_detections({mesh_name: (kp, score)}, mesh_gt, self.dist_thresh_list)
+        sorted_score = score[np.argsort(-score, kind='stable')]
+        self.meshes[classname][mesh_name] = (kp, score, sorted_score, match['tp'])
+
+    def add(self, pred):
+        """Match the rows of a predictions DataFrame, appended to the rows added before."""
+        groups = pred.groupby(['class', 'key'], sort=False, dropna=False)
+        for (classname, mesh_name), rows in groups:
+            kp, score = detection_arrays((rows[['coord_x', 'coord_y', 'coord_z']].to_numpy(dtype=np.float64),
+                                          rows['score'].to_numpy(dtype=np.float64)))
+            if classname not in self.meshes:
+                raise ValueError(f"Unknown class {classname!r} for scan {mesh_name!r}")
+            meshes = self.meshes[classname]
+            if mesh_name in meshes:
+                # more predictions of a mesh seen before: its matches depend on all of them
+                old_kp, old_score, _, _ = meshes[mesh_name]
+                kp = np.concatenate([old_kp, kp])
+                score = np.concatenate([old_score, score])
+            self._match(classname, mesh_name, kp, score)
+        self.n_predictions += len(pred)
+
+    def matches(self):
+        """Matches of every class as returned by metrics.match_map on all the predictions added."""
+        matches = {}
+        for classname, meshes in self.meshes.items():
+            mesh_names = list(meshes.keys())
+            states = list(meshes.values())
+            sorted_score = np.concatenate([state[2] for state in states] + [np.empty(0)])
+            tp = np.concatenate([state[3] for state in states] + [np.empty((len(self.dist_thresh_list), 0))],
+                                axis=1)
+            mesh_ids = np.repeat(np.arange(len(mesh_names)), [len(state[2]) for state in states])
+            # every mesh is sorted already, a stable sort merges them like the pooled sort
+            order = np.argsort(-sorted_score, kind='stable')
+            mesh_ids = mesh_ids[order]
+            by_mesh = np.argsort(mesh_ids, kind='stable')
+            bounds = np.searchsorted(mesh_ids[by_mesh], np.arange(len(mesh_names) + 1))
+            npos = {mesh_name: len(np.asarray(kp)) for mesh_name, kp in self.gt_all[classname].items()}
+            npos.update({mesh_name: 0 for mesh_name in mesh_names if mesh_name not in npos})
+            matches[classname] = {
+                'tp': tp[:, order],
+                'npos': npos,
+                'mesh_dets': {mesh_name: by_mesh[bounds[i]:bounds[i + 1]] for i, mesh_name in enumerate(mesh_names)},
+            }
+        return matches
+
+    def scores(self, per_scan=False):
+        """Leaderboard scores as written by score.py, and the per-scan metrics if asked for."""
+        matches = self.matches()
+        scores = reformat_scores(score(self.gt_all, None, matches=matches))
+        if not per_scan:
+            return scores
+        return scores, calculate_metrics_per_scan(None, self.gt_all, matches=matches)
+
+
+class CsvTail:
+    """New complete rows of a CSV file that is being appended to."""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.offset = 0
+        self.header = None
+
+    def truncated(self):
+        """True if the file is now shorter than what was read."""
+        return os.fstat(self.fp.fileno()).st_size < self.offset
+
+    def read(self, complete=False, limit=None):
+        """DataFrame of the rows completed since the last read, None if there are none.
+        With complete=True the file is known to be fully written and its last
+        line is read even without a newline. Nothing is read past the `limit`
+        offset when one is given."""
+        self.fp.seek(self.offset)
+        data = self.fp.read() if limit is None else self.fp.read(max(limit - self.offset, 0))
+        # the last line may still be being written
+        end = len(data) if complete else data.rfind(b"\n") + 1
+        if end == 0:
+            return None
+        self.offset += end
+        data = data[:end]
+        if self.header is None:
+            header_end = data.find(b"\n") + 1 or len(data)
+            self.header, data = data[:header_end], data[header_end:]
+        if not data.strip():
+            return None
+        return pd.read_csv(io.BytesIO(self.header + data), dtype=CSV_DTYPES)
+
+
+def _is_open_file(fp, filename):
+    """True if filename is the file open as fp, e.g. after it was renamed to filename."""
+    try:
+        stat = os.stat(filename)
+    except FileNotFoundError:
+        return False
+    open_stat = os.fstat(fp.fileno())
+    return (stat.st_dev, stat.st_ino) == (open_stat.st_dev, open_stat.st_ino)
+
+
+def _manifest_entries(manifest_file):
+    """Complete entries of a progress manifest, None if there is none."""
+    try:
+        with open(manifest_file, "rb") as fp:
+            return [line for line in fp.readlines() if line.endswith(b"\n")]
+    except FileNotFoundError:
+        return None
+
+
+def _open_predictions(tmp_file, predictions_file):
+    """(file open unbuffered, True if it is tmp_file), or (None, None) if neither exists."""
+    for filename, is_tmp in ((tmp_file, True), (predictions_file, False)):
+        try:
+            # unbuffered, a buffer could hold bytes the writer has truncated since
+            return open(filename, "rb", buffering=0), is_tmp
+        except FileNotFoundError:
+            pass
+    return None, None
+
+
+def follow(scorer, predictions_file, poll_interval=1., timeout=FOLLOW_TIMEOUT, done_file=None):
+    """Add the predictions to scorer as they are written, until they are complete.
+
+    PredictionWriter appends to <predictions_file>.tmp and renames it to
+    predictions_file once every scan is written: that file is followed, and
+    the predictions are complete once the rename is seen. While the progress
+    manifest of the writer (<predictions_file>.progress) exists, rows are only
+    read up to the end of the last scan it records, so only complete scans
+    are scored and rows dropped by a resuming writer are never read.
+
+    Without a temporary file, predictions_file itself is followed, but only
+    `done_file`, created once the writer has exited, tells that it is
+    complete. An existing predictions_file is never taken as complete on its
+    own. Following fails if done_file appears while the temporary file was
+    not renamed, or after `timeout` seconds without new predictions.
+    """
+    tmp_file = predictions_file + ".tmp"
+    manifest_file = predictions_file + ".progress"
+    last_change = time.monotonic()
+    fp = None
+    # following tmp_file rather than predictions_file
+    is_tmp = None
+    try:
+        while True:
+            # checked before looking at the files: the writer is done with them
+            done = done_file is not None and os.path.exists(done_file)
+            if fp is not None and not is_tmp and (os.path.exists(tmp_file) or
+                                                  not _is_open_file(fp, predictions_file)):
+                # a temporary file was started, or predictions_file replaced: left from an earlier run
+                fp.close()
+                fp = None
+            if fp is None:
+                fp, is_tmp = _open_predictions(tmp_file, predictions_file)
+                if fp is None:
+                    if done:
+                        raise RuntimeError(f"{predictions_file} was not written")
+                    if timeout is not None and time.monotonic() - last_change > timeout:
+                        raise TimeoutError(f"{tmp_file} was not created")
+                    time.sleep(poll_interval)
+                    continue
+                scorer.reset()
+                tail = CsvTail(fp)
+                # manifest entries of the scans read so far
+                consumed = []
+
+            if is_tmp:
+                # renamed once complete: the open file is the final one, checked before
+                # reading so that the read gets everything written before the rename
+                finished = _is_open_file(fp, predictions_file)
+                if done and not finished:
+                    raise RuntimeError(f"{tmp_file} was not renamed to {predictions_file}, "
+                                       "the writer stopped before every scan was written")
+            else:
+                finished = done
+            entries = _manifest_entries(manifest_file) if is_tmp and not finished else None
+            if tail.truncated() or entries is not None and entries[:len(consumed)] != consumed:
+                # the writer started over
+                scorer.reset()
+                tail = CsvTail(fp)
+                consumed = []
+            limit = None
+            if entries is not None:
+                limit = json.loads(entries[-1])["size"] if entries else tail.offset
+                consumed = entries
+            pred = tail.read(complete=finished, limit=limit)
+            if pred is not None:
+                scorer.add(pred)
+                last_change = time.monotonic()
+            elif finished:
+                return scorer
+            elif timeout is not None and time.monotonic() - last_change > timeout:
+                raise TimeoutError(f"no new predictions in {predictions_file} for {timeout} s")
+            else:
+                time.sleep(poll_interval)
+    finally:
+        if fp is not None:
+            fp.close()
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    gold = load_goldstandard(args.goldstandard_file)
+    scorer = IncrementalScorer(gold)
+
+    if args.follow:
+        follow(scorer, args.predictions_file, args.poll_interval, args.timeout, args.done_file)
+    else:
+        with pd.read_csv(args.predictions_file, dtype=CSV_DTYPES, chunksize=1_000_000) as reader:
+            for pred in reader:
+                scorer.add(pred)
+
+    if args.per_scan_output:
+        scores, scan_metrics = scorer.scores(per_scan=True)
+        with open(args.per_scan_output, "w") as out:
+            out.write(json.dumps(scan_metrics))
+    else:
+        scores = scorer.scores()
+    with open(args.output, "w") as out:
+        res = {"submission_status": "SCORED", **scores}
+        out.write(json.dumps(res))
+
+
+if __name__ == "__main__":
+    main()
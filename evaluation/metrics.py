@@ -1,6 +1,16 @@
 import numpy as np
+from scipy.spatial import cKDTree
 # import matplotlib.pyplot as plt
 
+# distance thresholds averaged by mAP/mAR: 0.0, 0.1, ..., 2.9
+DIST_THRESH_LIST = [0.1 * i for i in range(0, 30)]
+# number of gt keypoints in a scan from which the nearest-gt lookup uses a
+# KD-tree instead of the dense detections x gt distance matrix, or the size
+# of that matrix above which the KD-tree is used anyway to bound memory
+KDTREE_MIN_GT = 64
+DENSE_MAX_PAIRS = 2 ** 22
+
+
 def voc_ar(dist_thresh_list, recall, keypoint_cat):
     # correct AP calculation
     # first append sentinel values at the end
@@ -10,8 +20,7 @@ def voc_ar(dist_thresh_list, recall, keypoint_cat):
     mpre = np.concatenate(([0.], mpre, [0.]))
 
     # compute the recall envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -47,8 +56,7 @@ def voc_ap(rec, prec, threshold, keypoint_cat):
     mpre = np.concatenate(([0.], prec, [0.]))
 
     # compute the precision envelope
-    for i in range(mpre.size - 1, 0, -1):
-        mpre[i - 1] = np.maximum(mpre[i - 1], mpre[i])
+    mpre = np.maximum.accumulate(mpre[::-1])[::-1]
 
     # to calculate area under PR curve, look for points
     # where X axis (recall) changes value
@@ -71,74 +79,168 @@ def voc_ap(rec, prec, threshold, keypoint_cat):
 
 
 def eval_det_cls_map(pred, gt, dist_thresh, classname):
+    """ Single threshold version of eval_det_cls_map_sweep. """
+    rec, prec, ap = eval_det_cls_map_sweep(pred, gt, [dist_thresh], classname)
+    return rec[0], prec[0], ap[0]
+
+def detection_arrays(dets):
+    """ (N, 3) float64 coordinates and (N,) scores of the detections of one mesh,
+        given either as a list of (kp, score) pairs or as a (kp, score) tuple of
+        arrays as returned by load_predictions.
+    """
+    if isinstance(dets, tuple):
+        kp, score = dets
+    else:
+        kp = [kp for kp, _ in dets]
+        score = [score for _, score in dets]
+    return np.asarray(kp, dtype=np.float64).reshape(-1, 3), np.asarray(score, dtype=np.float64)
+
+
+def nearest_gt(kp, kpgt):
+    """ Distance to, and index of, the nearest gt keypoint of every detection.
+        Input:
+            kp: (N, 3) detections
+            kpgt: (M, 3) gt keypoints, M > 0
+        Output:
+            dmin: (N,) distances
+            jmin: (N,) indices into kpgt
+    """
+    if len(kpgt) >= KDTREE_MIN_GT or len(kp) * len(kpgt) > DENSE_MAX_PAIRS:
+        dmin, jmin = cKDTree(kpgt).query(kp)
+        return dmin, jmin.astype(np.int64)
+    distance = np.linalg.norm(kp[:, None, :] - kpgt[None, :, :], axis=2)
+    jmin = np.argmin(distance, axis=1)
+    dmin = distance[np.arange(len(kp)), jmin]
+    return dmin, jmin
+
+
+def match_detections(pred, gt, dist_thresh_list):
+    """ Greedy matching of the detections of one class, for several distance
+        thresholds in one pass: detections are sorted and matched to their
+        nearest ground truth keypoint once, only the greedy TP/FP assignment
+        is repeated per threshold.
+        Detections can only match keypoints of their own mesh and are sorted
+        stably (ties keep their input order: by mesh in the order of `pred`,
+        then in the order of each mesh's detections), so the detections of one mesh
+        are matched exactly as if that mesh was evaluated alone: the result
+        gives both the pooled and the per-mesh precision/recall.
+        Input:
+            pred: map of {meshname: [(kp, score)]} or {meshname: (kp array, score array)}
+            gt: map of {meshname: [kp]}
+            dist_thresh_list: list of T distance thresholds
+        Output:
+            map of {'tp': (T, nd) array of 1. for TPs and 0. for FPs, by decreasing confidence,
+                    'npos': {meshname: number of gt keypoints} for the meshes of gt and pred,
+                    'mesh_dets': {meshname: indices into the nd detections} for the meshes of pred}
+    """
     # construct gt objects
-    class_recs = {}  # {mesh name: {'kp': kp list, 'det': matched list}}
+    class_recs = {}  # {mesh name: {'kp': kp array, 'offset': index of its first kp}}
     npos = 0
     for mesh_name in gt.keys():
-        keypoints = np.array(gt[mesh_name])
-        det = [False] * len(keypoints)
+        keypoints = np.asarray(gt[mesh_name])
+        class_recs[mesh_name] = {'kp': keypoints, 'offset': npos}
         npos += len(keypoints)
-        class_recs[mesh_name] = {'kp': keypoints, 'det': det}
     # pad empty list to all other imgids
     for mesh_name in pred.keys():
         if mesh_name not in gt:
-            class_recs[mesh_name] = {'kp': np.array([]), 'det': []}
+            class_recs[mesh_name] = {'kp': np.array([]), 'offset': npos}
 
-    # construct dets
-    mesh_names = []
-    confidence = []
-    KP = []
-    for mesh_name in pred.keys():
-        for kp, score in pred[mesh_name]:
-            mesh_names.append(mesh_name)
-            confidence.append(score)
-            KP.append(kp)
-    confidence = np.array(confidence)
-    KP = np.array(KP)
+    # construct dets, remembering the mesh of each one as an index into mesh_names
+    mesh_names = list(pred.keys())
+    dets = [detection_arrays(pred[mesh_name]) for mesh_name in mesh_names]
+    KP = np.concatenate([kp for kp, _ in dets] + [np.empty((0, 3))])
+    confidence = np.concatenate([score for _, score in dets] + [np.empty(0)])
+    mesh_ids = np.repeat(np.arange(len(mesh_names)), [len(score) for _, score in dets])
 
     # sort by confidence
-    sorted_ind = np.argsort(-confidence)
-    sorted_scores = np.sort(-confidence)
+    sorted_ind = np.argsort(-confidence, kind='stable')
     KP = KP[sorted_ind, ...]
-    mesh_names = [mesh_names[x] for x in sorted_ind]
-
-    # go down dets and mark TPs and FPs
-    nd = len(mesh_names)
-    tp = np.zeros(nd)
-    fp = np.zeros(nd)
-    for d in range(nd):
-        R = class_recs[mesh_names[d]]
-        kp = KP[d]
-        dmin = np.inf
+    mesh_ids = mesh_ids[sorted_ind]
+
+    # nearest gt keypoint of every detection, independent of the threshold,
+    # computed in one batch per mesh
+    nd = len(mesh_ids)
+    dmin = np.full(nd, np.inf)
+    jmin = np.full(nd, -1, dtype=np.int64)  # index into the flattened gt keypoints
+    by_mesh = np.argsort(mesh_ids, kind='stable')
+    bounds = np.searchsorted(mesh_ids[by_mesh], np.arange(len(mesh_names) + 1))
+    mesh_dets = {}
+    for mesh_id, mesh_name in enumerate(mesh_names):
+        R = class_recs[mesh_name]
         KPGT = R['kp']
+        det_ind = by_mesh[bounds[mesh_id]:bounds[mesh_id + 1]]
+        mesh_dets[mesh_name] = det_ind
+        if KPGT.size > 0 and det_ind.size > 0:
+            dmin[det_ind], j = nearest_gt(KP[det_ind], KPGT.reshape(-1, 3))
+            jmin[det_ind] = R['offset'] + j
 
-        if KPGT.size > 0:
-            distance = np.linalg.norm(np.array(kp).reshape(-1, 3) - KPGT, axis=1)
-            dmin = min(distance)
-            jmin = np.argmin(distance)
-
-        # print dmin
-        if dmin < dist_thresh:
-            if not R['det'][jmin]:
-                tp[d] = 1.
-                R['det'][jmin] = 1
-            else:
-                fp[d] = 1.
-        else:
-            fp[d] = 1.
+    # greedy matching: within the threshold, the first (most confident)
+    # detection claiming a gt keypoint is a TP, all the others are FPs
+    tp = np.zeros((len(dist_thresh_list), nd))
+    for t, dist_thresh in enumerate(dist_thresh_list):
+        cand = np.flatnonzero(dmin < dist_thresh)
+        _, first = np.unique(jmin[cand], return_index=True)
+        tp[t, cand[first]] = 1.
+
+    return {'tp': tp,
+            'npos': {mesh_name: len(R['kp']) for mesh_name, R in class_recs.items()},
+            'mesh_dets': mesh_dets}
+
+
+def precision_recall(tp, npos, dist_thresh_list, classname):
+    """ Precision/recall curves of matched detections.
+        Input:
+            tp: (T, nd) array of 1. for TPs and 0. for FPs, by decreasing confidence
+            npos: number of gt keypoints
+            dist_thresh_list: list of T distance thresholds
+        Output:
+            rec: (T, nd) array
+            prec: (T, nd) array
+            ap: (T,) array
+    """
+    fp = 1. - tp
 
     # compute precision recall
-    fp = np.cumsum(fp)
-    tp = np.cumsum(tp)
+    fp = np.cumsum(fp, axis=1)
+    tp = np.cumsum(tp, axis=1)
     rec = tp / float(npos)
-    # print('NPOS: ' + str(npos))
-    # avoid divide by zero in case the first detection matches a difficult
-    # ground truth
     prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-    ap = voc_ap(rec, prec, dist_thresh, classname)
+    ap = np.array([voc_ap(rec[t], prec[t], dist_thresh, classname)
+                   for t, dist_thresh in enumerate(dist_thresh_list)])
     return rec, prec, ap
 
 
+def mesh_precision_recall(match, mesh_name, dist_thresh_list, classname):
+    """ Precision/recall curves of the detections of one mesh, as returned by
+        eval_det_cls_map_sweep for that mesh alone.
+        Input:
+            match: as returned by match_detections
+            mesh_name: mesh of the gt or of the detections, or any other mesh
+        Output:
+            as precision_recall
+    """
+    det_ind = match['mesh_dets'].get(mesh_name, np.empty(0, dtype=np.int64))
+    return precision_recall(match['tp'][:, det_ind], match['npos'].get(mesh_name, 0),
+                            dist_thresh_list, classname)
+
+
+def eval_det_cls_map_sweep(pred, gt, dist_thresh_list, classname):
+    """ Keypoint detection precision/recall of one class, evaluated for
+        several distance thresholds in one matching pass.
+        Input:
+            pred: map of {meshname: [(kp, score)]} or {meshname: (kp array, score array)}
+            gt: map of {meshname: [kp]}
+            dist_thresh_list: list of T distance thresholds
+        Output:
+            rec: (T, nd) array
+            prec: (T, nd) array
+            ap: (T,) array
+    """
+    match = match_detections(pred, gt, dist_thresh_list)
+    return precision_recall(match['tp'], sum(len(np.asarray(kp)) for kp in gt.values()),
+                            dist_thresh_list, classname)
+
+
 def eval_map(pred_all, gt_all, dist_thresh=0.1):
     """ Generic functions to compute precision/recall for keypoint detection
         for multiple classes.
@@ -162,6 +264,45 @@ def eval_map(pred_all, gt_all, dist_thresh=0.1):
     return rec, prec, ap
 
 
+def match_map(pred_all, gt_all, dist_thresh_list=DIST_THRESH_LIST):
+    """ match_detections of every class.
+        Input:
+            pred_all: map of {classname: {meshname: [(kp, score)]}}
+            gt_all: map of {classname: {meshname: [kp]}}
+            dist_thresh_list: list of T distance thresholds
+        Output:
+            map of {classname: match}
+    """
+    return {classname: match_detections(pred_all[classname], gt_all[classname], dist_thresh_list)
+            for classname in gt_all.keys()}
+
+
+def eval_map_sweep(pred_all, gt_all, dist_thresh_list=DIST_THRESH_LIST, matches=None):
+    """ Multi-threshold version of eval_map.
+        Input:
+            pred_all: map of {classname: {meshname: [(kp, score)]}}
+            gt_all: map of {classname: {meshname: [kp]}}
+            dist_thresh_list: list of T distance thresholds
+            matches: match_map(pred_all, gt_all, dist_thresh_list) if already computed
+        Output:
+            rec: {classname: (T, nd) array}
+            prec: {classname: (T, nd) array}
+            ap: {classname: (T,) array}
+    """
+    if matches is None:
+        matches = match_map(pred_all, gt_all, dist_thresh_list)
+
+    rec = {}
+    prec = {}
+    ap = {}
+    for classname in gt_all.keys():
+        npos = sum(len(np.asarray(kp)) for kp in gt_all[classname].values())
+        rec[classname], prec[classname], ap[classname] = precision_recall(matches[classname]['tp'], npos,
+                                                                          dist_thresh_list, classname)
+
+    return rec, prec, ap
+
+
 def filter_scan(all_scans, scan_name):
     all_filtered = {}
     for category, data_dict in all_scans.items():
@@ -173,7 +314,14 @@ def filter_scan(all_scans, scan_name):
     return all_filtered
 
 
-def calculate_metrics_per_scan(pred_submission, gt_all):
+def load_predictions(pred_submission):
+    """ Group the rows of a predictions DataFrame by (class, key) in a single pass.
+        Input:
+            pred_submission: DataFrame with key, coord_x, coord_y, coord_z, class and score columns
+        Output:
+            map of {classname: {meshname: (kp, score)}} where kp is a contiguous (N, 3)
+            float64 array and score a (N,) float64 array, rows kept in file order
+    """
     pred_all_map = {
         "Mesial": {},
         "Distal": {},
@@ -182,17 +330,37 @@ def calculate_metrics_per_scan(pred_submission, gt_all):
         "OuterPoint": {},
         "FacialPoint": {}
     }
-    scans_list = set()
-    for _, row in pred_submission.iterrows():
-        class_name = row['class']
-        key = row['key']
-        scans_list.add(key)
-        coord = [row['coord_x'], row['coord_y'], row['coord_z']]
-        prob = row['score']
-        if key not in pred_all_map[class_name]:
-            pred_all_map[class_name][key] = [[coord, prob]]
+    # groups are numbered in order of first appearance, like the dict insertion order
+    # of the former row by row loader
+    group = pred_submission.groupby(['class', 'key'], sort=False, dropna=False).ngroup().to_numpy()
+    order = np.argsort(group, kind='stable')
+    bounds = np.searchsorted(group[order], np.arange(group.max(initial=-1) + 2))
+    coords = pred_submission[['coord_x', 'coord_y', 'coord_z']].to_numpy(dtype=np.float64)[order]
+    scores = pred_submission['score'].to_numpy(dtype=np.float64)[order]
+    classes = pred_submission['class'].to_numpy()[order]
+    keys = pred_submission['key'].to_numpy()[order]
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        pred_all_map[classes[start]][keys[start]] = (coords[start:end], scores[start:end])
+    return pred_all_map
+
+
+def calculate_metrics_per_scan(pred_submission, gt_all, matches=None):
+    """ mAP and mAR of every gt scan.
+        Input:
+            pred_submission: predictions DataFrame, or map as returned by load_predictions
+            gt_all: map of {classname: {meshname: [kp]}}
+            matches: match_map(pred_all_map, gt_all, DIST_THRESH_LIST) if already computed
+        Output:
+            map of {meshname: {"mAP": {classname: scalar}, "mAR": {classname: scalar}}}
+    """
+    dist_thresh_list = DIST_THRESH_LIST
+    if matches is None:
+        if isinstance(pred_submission, dict):
+            pred_all_map = pred_submission
         else:
-            pred_all_map[class_name][key].append([coord, prob])
+            pred_all_map = load_predictions(pred_submission)
+        # all scans and distance thresholds at once
+        matches = match_map(pred_all_map, gt_all, dist_thresh_list)
 
     all_metrics = {}
     scans_list = list(gt_all['Cusp'].keys())
@@ -205,26 +373,16 @@ def calculate_metrics_per_scan(pred_submission, gt_all):
             "OuterPoint": [],
             "FacialPoint": []
         }
-        dist_thresh_list = []
-        metrics = {}
-        gt = filter_scan(gt_all, scan)
-        pred = filter_scan(pred_all_map, scan)
-        # define distance threshold
-        for i in range(0, 30):
-            dist_thresh = 0.1 * i
-            rec, prec, ap = eval_map(pred, gt, dist_thresh=dist_thresh)
-            metrics[str(i)] = ap
-            dist_thresh_list.append(dist_thresh)
-            for cat in rec.keys():
-                try:
-                    recall[cat].append(rec[cat][-1])
-                except:
-                    recall[cat].append(0)
+        ap = {}
+        for cat, match in matches.items():
+            rec, prec, ap[cat] = mesh_precision_recall(match, scan, dist_thresh_list, cat)
+            try:
+                recall[cat] = list(rec[:, -1])
+            except IndexError:
+                recall[cat] = [0] * len(dist_thresh_list)
         # Collect all values for each class
-        class_values = {'Mesial': [], 'Distal': [], 'Cusp': [], 'InnerPoint': [], 'OuterPoint': [], 'FacialPoint': []}
-        for threshold in metrics.values():
-            for class_name in class_values.keys():
-                class_values[class_name].append(threshold[class_name])
+        class_values = {class_name: list(ap[class_name]) for class_name in
+                        ['Mesial', 'Distal', 'Cusp', 'InnerPoint', 'OuterPoint', 'FacialPoint']}
 
         # Calculate the mean for each class
         map = {class_name: sum(values) / len(values) for class_name, values in class_values.items()}
@@ -0,0 +1,101 @@
+"""On-disk cache of per-scan metrics.
+
+Entries hold the calculate_metrics_per_scan result of one predictions file
+and are keyed by the content hash of that file, the content hash of the
+goldstandard and the metric parameters, so that a changed submission,
+goldstandard or threshold list never hits a stale entry. The cache is
+bounded in size: least recently used entries are evicted first.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+from metrics import DIST_THRESH_LIST
+
+# bump when the way metrics are computed changes, to invalidate every entry
+CACHE_VERSION = 2
+
+
+def file_digest(filename, chunk_size=1 << 20):
+    """sha256 hex digest of a file's content."""
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class MetricsCache:
+    """Size-bounded LRU cache of {scan: {"mAP": .., "mAR": ..}} results in `cache_dir`."""
+
+    def __init__(self, cache_dir, max_bytes=1 << 30, dist_thresh_list=DIST_THRESH_LIST):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.params = json.dumps({"version": CACHE_VERSION, "dist_thresh_list": list(dist_thresh_list)})
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, predictions_digest, goldstandard_digest):
+        """Cache key of a (predictions, goldstandard) pair of content digests."""
+        return hashlib.sha256(
+            "\n".join([predictions_digest, goldstandard_digest, self.params]).encode()
+        ).hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def get(self, key):
+        """Cached metrics for `key`, or None."""
+        path = self._path(key)
+        try:
+            with open(path) as fp:
+                metrics = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        # mark as recently used
+        os.utime(path)
+        return metrics
+
+    def put(self, key, metrics):
+        """Store metrics under `key`, then evict entries beyond max_bytes."""
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as fp:
+            json.dump(metrics, fp)
+        os.replace(tmp_path, self._path(key))
+        self.evict()
+
+    def entries(self):
+        """(mtime, size, path) of every entry, least recently used first."""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".json"):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return sorted(entries)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """Remove every entry."""
+        for _, _, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
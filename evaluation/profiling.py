@@ -0,0 +1,125 @@
+"""Stage-level timing of the evaluation scripts.
+
+score.py and rank.py wrap their stages (CSV parsing, goldstandard loading,
+matching, AP/AR integration, Wilcoxon tests, ...) in StageProfiler.stage.
+When profiling is off, stage() returns a shared no-op context manager, so
+the instrumentation costs a method call per stage. When it is on, the wall
+time, CPU time and memory of every stage are written to a JSON file, and
+the whole run can also be recorded by cProfile.
+
+Profiling is turned on by the --profile, --profile_memory and --cprofile
+arguments of the scripts, or without changing the command line by setting
+the EVAL_PROFILE environment variable to 1 (timings) or "memory" (timings
+and tracemalloc peaks).
+"""
+
+import contextlib
+import cProfile
+import json
+import os
+import resource
+import time
+import tracemalloc
+
+PROFILE_ENV = "EVAL_PROFILE"
+
+# returned by stage() when profiling is off
+_NO_STAGE = contextlib.nullcontext()
+
+
+def add_profile_args(parser):
+    """Add the profiling arguments to an argparse parser."""
+    parser.add_argument("--profile", action="store_true",
+                        help=f"write the time spent in every stage to a JSON file (or set {PROFILE_ENV}=1)")
+    parser.add_argument("--profile_memory", action="store_true",
+                        help=f"also trace the peak memory allocated by every stage, slower (or set {PROFILE_ENV}=memory)")
+    parser.add_argument("--cprofile", type=str, default=None,
+                        help="dump cProfile statistics of the whole run to this file")
+
+
+def _cpu_time():
+    """CPU time of this process and of its terminated children, e.g. pool workers."""
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def _max_rss_mb():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class StageProfiler:
+    """Wall time, CPU time and memory of the named stages of a run."""
+
+    def __init__(self, enabled=False, trace_memory=False, cprofile_file=None):
+        self.trace_memory = trace_memory
+        self.cprofile_file = cprofile_file
+        self.enabled = enabled or trace_memory or cprofile_file is not None
+        self.stages = []
+        self._profile = None
+        self._start = None
+
+    @classmethod
+    def from_args(cls, args):
+        """Profiler configured by add_profile_args arguments and the environment."""
+        env = os.environ.get(PROFILE_ENV, "").lower()
+        return cls(enabled=args.profile or env not in ("", "0"),
+                   trace_memory=args.profile_memory or env == "memory",
+                   cprofile_file=args.cprofile)
+
+    def start(self):
+        """Start timing the run, and cProfile if asked for."""
+        if not self.enabled:
+            return
+        self._start = time.perf_counter()
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.cprofile_file is not None:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+
+    def stage(self, name):
+        """Context manager recording the stage `name`; stages must not be nested."""
+        if not self.enabled:
+            return _NO_STAGE
+        return self._stage(name)
+
+    @contextlib.contextmanager
+    def _stage(self, name):
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        wall = time.perf_counter()
+        cpu = _cpu_time()
+        try:
+            yield
+        finally:
+            stage = {"name": name,
+                     "wall_s": time.perf_counter() - wall,
+                     "cpu_s": _cpu_time() - cpu,
+                     "max_rss_mb": _max_rss_mb()}
+            if self.trace_memory:
+                stage["peak_traced_mb"] = tracemalloc.get_traced_memory()[1] / 1e6
+            self.stages.append(stage)
+
+    def write(self, filename):
+        """Stop profiling and write the stages to `filename` as JSON."""
+        if not self.enabled:
+            return
+        if self._profile is not None:
+            self._profile.disable()
+            self._profile.dump_stats(self.cprofile_file)
+        if self.trace_memory:
+            tracemalloc.stop()
+        total = time.perf_counter() - self._start if self._start is not None else None
+        with open(filename, "w") as out:
+            json.dump({"total_wall_s": total,
+                       "max_rss_mb": _max_rss_mb(),
+                       "trace_memory": self.trace_memory,
+                       "cprofile_file": self.cprofile_file,
+                       "stages": self.stages}, out, indent=2)
+        print(f"profile written to {filename}")
+
+
+def profile_filename(output):
+    """Profile file written next to an output file: results.json -> results_profile.json."""
+    return os.path.splitext(output)[0] + "_profile.json"
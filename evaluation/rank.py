@@ -1,74 +1,84 @@
+import argparse
 import json
+import multiprocessing
 
 import numpy as np
-from scipy.stats import wilcoxon
 from glob import glob
+from goldstandard import load_goldstandard
 from metrics import calculate_metrics_per_scan
+from metrics_cache import MetricsCache, file_digest
+from profiling import StageProfiler, add_profile_args
+from signed_rank import signed_rank_pvalue
 import pandas as pd
-import pickle
 from tqdm import tqdm
 import random
 import seaborn as sns
 import matplotlib.pyplot as plt
 
 
+METRICS = ['mAP', 'mAR']
+CATEGORIES = [
+    "Mesial",
+    "Distal",
+    "Cusp",
+    "InnerPoint",
+    "OuterPoint",
+    "FacialPoint"
+]
+
+
+def pack_metrics(metrics_dict, scan_names, teams=None):
+    """Per-scan metric values as a (teams, scans, metrics, categories) array,
+    rounded to 4 decimals like the values compared by the Wilcoxon tests."""
+    if teams is None:
+        teams = list(metrics_dict.keys())
+    values = np.array([[[[metrics_dict[team][scan_name][metric][category] for category in CATEGORIES]
+                         for metric in METRICS]
+                        for scan_name in scan_names]
+                       for team in teams], dtype=np.float64).reshape(len(teams), len(scan_names),
+                                                                     len(METRICS), len(CATEGORIES))
+    return np.round(values, decimals=4)
+
+
+def compare_teams_packed(values, scan_index, alpha=0.001, order=None):
+    """Pairwise comparison of all teams of a pack_metrics array on the scans
+    `scan_index`, returns the points of every team and the team order used
+    for the comparisons.
+
+    Teams are visited in `order`, a random one from the `random` module by
+    default, and when a significant difference comes with equal means the
+    point goes to the later team of the pair.
+    """
+    num_teams = values.shape[0]
+    if order is None:
+        order = list(range(num_teams))
+        random.shuffle(order)
+    order = np.asarray(order, dtype=np.int64)
+    # (teams, metrics, categories, scans), scans contiguous for the reductions
+    sample = np.ascontiguousarray(np.moveaxis(values[:, scan_index], 1, -1))
+    means = np.mean(sample, axis=-1)
+
+    # all pairs (i < j in visiting order) and all (metric, category) in one batch
+    first, second = np.triu_indices(num_teams, 1)
+    team1 = order[first]
+    team2 = order[second]
+    # Perform the Wilcoxon Signed Rank Tests
+    p_value = signed_rank_pvalue(sample[team1], sample[team2])
+
+    # Check if one team is statistically better
+    significant = p_value < alpha
+    team1_better = means[team1] > means[team2]
+    points = np.zeros(num_teams, dtype=np.int64)
+    np.add.at(points, team1, np.sum(significant & team1_better, axis=(1, 2)))
+    np.add.at(points, team2, np.sum(significant & ~team1_better, axis=(1, 2)))
+    return points, order
+
+
 def compare_teams(metrics_dict, scan_names, alpha=0.001):
     teams = list(metrics_dict.keys())
-    random.shuffle(teams)
-    metrics = ['mAP', 'mAR']
-    points = {team: 0 for team in teams}
-    categories = [
-        "Mesial",
-        "Distal",
-        "Cusp",
-        "InnerPoint",
-        "OuterPoint",
-        "FacialPoint"
-    ]
-    # Perform pairwise comparison for each metric
-    for i in range(len(teams)):
-        for j in range(i+1, len(teams)):
-            for metric in metrics:
-                for category in categories:
-                    # Compare each pair of teams
-                    team1 = teams[i]
-                    team2 = teams[j]
-
-                    # Prepare metric values for comparison
-                    team1_values = np.round(
-                        [metrics_dict[team1][scan_name][metric][category] for scan_name in scan_names],
-                        decimals=4)
-                    team2_values = np.round(
-                        [metrics_dict[team2][scan_name][metric][category] for scan_name in scan_names],
-                        decimals=4)
-                    # Perform the Wilcoxon Signed Rank Test
-                    stat = wilcoxon(team1_values, team2_values, alternative="two-sided", method="exact")
-                    p_value = stat.pvalue
-
-
-                    # Check if one team is statistically better
-                    if p_value < alpha:
-                        mean1 = np.mean(team1_values)
-                        mean2 = np.mean(team2_values)
-                        if mean1 > mean2:
-                            points[team1] += 1
-                            better_team = team1
-                        else:
-                            points[team2] += 1
-                            better_team = team2
-
-                        # plt.figure(figsize=(10, 6))
-                        # sns.kdeplot(team1_values, label=f'{team1} - {metric} - {category}', shade=True, color='blue')
-                        # sns.kdeplot(team2_values, label=f'{team2} - {metric} - {category}', shade=True, color='orange')
-                        # plt.title(f'Distribution of Values for {metric} ({category})\nP-value={p_value} < {alpha} '
-                        #           f'\nBetter team is {better_team}', fontsize=14)
-                        # plt.xlabel('Metric Value')
-                        # plt.ylabel('Density')
-                        # plt.legend()
-                        # plt.grid()
-                        # plt.tight_layout()
-                        # plt.show()
-    return points
+    values = pack_metrics(metrics_dict, scan_names, teams)
+    points, order = compare_teams_packed(values, np.arange(len(scan_names)), alpha)
+    return {teams[team]: int(points[team]) for team in order}
 
 
 def normalize_points(bootstrap_points, num_teams, num_metrics, num_categories, n_bootstraps):
@@ -80,48 +90,167 @@ def normalize_points(bootstrap_points, num_teams, num_metrics, num_categories, n
     return normalized_scores
 
 
-def bootstrap_compare(metrics_dict, scan_names, alpha=0.001, n_bootstraps=100, resample_frac=0.9):
+# packed metric values of the bootstrap worker processes
+_values = None
+
+
+def _init_bootstrap_worker(values):
+    global _values
+    _values = values
+
+
+def _bootstrap_points(seeds, num_samples, alpha):
+    """Sum of the points of the bootstrap iterations seeded by `seeds`."""
+    num_teams, num_scans = _values.shape[:2]
+    points = np.zeros(num_teams, dtype=np.int64)
+    for seed in seeds:
+        # one independent stream per iteration, whichever process runs it
+        rng = np.random.default_rng(seed)
+        bootstrap_sample = rng.choice(num_scans, num_samples, replace=False)
+        order = rng.permutation(num_teams)
+        bootstrap_points, _ = compare_teams_packed(_values, bootstrap_sample, alpha, order=order)
+        points += bootstrap_points
+    return points
+
+
+def bootstrap_compare(metrics_dict, scan_names, alpha=0.001, n_bootstraps=100, resample_frac=0.9, seed=None,
+                      workers=1):
+    """Points of every team summed over `n_bootstraps` comparisons on random
+    subsets of `resample_frac` of the scans.
+
+    Iteration i draws its scans and team order from the i-th stream spawned
+    from `seed`, so the result only depends on `seed`, not on the number of
+    worker processes the iterations are spread over.
+    """
+    global _values
     teams = list(metrics_dict.keys())
-    total_bootstrap_points = {team: 0 for team in teams}
+    # metric values are packed once, resamples are index arrays into them
+    values = pack_metrics(metrics_dict, scan_names, teams)
+    num_samples = int(len(scan_names) * resample_frac)
+    seeds = np.random.SeedSequence(seed).spawn(n_bootstraps)
 
-    for _ in range(n_bootstraps):
-        # Resample 90% of scan names
-        bootstrap_sample = random.sample(scan_names, int(len(scan_names) * resample_frac))
+    if workers <= 1:
+        _values = values
+        total_bootstrap_points = _bootstrap_points(seeds, num_samples, alpha)
+    else:
+        chunks = [seeds[i::workers] for i in range(workers)]
+        with multiprocessing.Pool(workers, initializer=_init_bootstrap_worker, initargs=(values,)) as pool:
+            chunk_points = pool.starmap(_bootstrap_points, [(chunk, num_samples, alpha) for chunk in chunks])
+        total_bootstrap_points = np.sum(chunk_points, axis=0, dtype=np.int64)
 
-        # Perform pairwise comparison on resampled data
-        bootstrap_points = compare_teams(metrics_dict, bootstrap_sample, alpha)
+    return {team: int(points) for team, points in zip(teams, total_bootstrap_points)}
 
-        # Accumulate the points from this bootstrap sample
-        for team, points in bootstrap_points.items():
-            total_bootstrap_points[team] += points
 
-    return total_bootstrap_points
+def get_args():
+    """Set up command-line interface and get arguments."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-p", "--predictions_dir", type=str, default="./teams_predictions/final",
+                        help="directory holding one <team>/predictions.csv per team")
+    parser.add_argument("-g", "--goldstandard_file", type=str, default="ground_truth_private_test.pkl")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                        help="number of processes scoring teams and running bootstrap iterations in parallel")
+    parser.add_argument("-n", "--n_bootstraps", type=int, default=100, help="number of bootstrap iterations")
+    parser.add_argument("-s", "--seed", type=int, default=None, help="seed of the bootstrap iterations")
+    parser.add_argument("--cache_dir", type=str, default=None,
+                        help="directory caching per-scan metrics of unchanged predictions files")
+    parser.add_argument("--cache_max_mb", type=float, default=1024, help="size limit of the metrics cache")
+    parser.add_argument("--clear_cache", action="store_true", help="empty the metrics cache first")
+    parser.add_argument("--profile_output", type=str, default="rank_profile.json",
+                        help="file of the stage timings written when profiling")
+    add_profile_args(parser)
+    return parser.parse_args()
 
 
-if __name__ == "__main__":
+# goldstandard of the worker processes, inherited from the parent when forking
+_gt_all = None
+
+
+def _init_worker(goldstandard_file):
+    global _gt_all
+    if _gt_all is None:
+        # spawned rather than forked: load it, memory-mapped if it is an .npz
+        _gt_all = load_goldstandard(goldstandard_file)
+
+
+def _score_team(team_pred_file):
+    pred_submission = pd.read_csv(team_pred_file)
+    return calculate_metrics_per_scan(pred_submission, _gt_all)
+
+
+def score_teams(teams_predictions_files_path, gt_all, goldstandard_file, workers=1, cache=None):
+    """Per-scan metrics of every team, {team: {scan: {"mAP": .., "mAR": ..}}}.
+
+    Teams are scored by a pool of `workers` processes sharing the goldstandard,
+    results are collected in team name order whatever the number of workers.
+    With a MetricsCache, only teams whose predictions file is not cached yet
+    are scored.
+    """
+    global _gt_all
+    teams_predictions_files_path = sorted(teams_predictions_files_path)
+    team_names = [team_pred_file.split('/')[-2] for team_pred_file in teams_predictions_files_path]
+    all_metrics = {}
+    cache_keys = {}
+    if cache is not None:
+        goldstandard_digest = file_digest(goldstandard_file)
+        for team_name, team_pred_file in zip(team_names, teams_predictions_files_path):
+            cache_keys[team_name] = cache.key(file_digest(team_pred_file), goldstandard_digest)
+            cached = cache.get(cache_keys[team_name])
+            if cached is not None:
+                all_metrics[team_name] = cached
+        print(f"{len(all_metrics)}/{len(team_names)} teams found in the metrics cache")
+    to_score = [(team_name, team_pred_file) for team_name, team_pred_file in zip(team_names, teams_predictions_files_path)
+                if team_name not in all_metrics]
+    to_score_files = [team_pred_file for _, team_pred_file in to_score]
+
+    _gt_all = gt_all
+    if workers <= 1 or len(to_score) <= 1:
+        scored = [_score_team(team_pred_file) for team_pred_file in tqdm(to_score_files)]
+    else:
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork" if "fork" in methods else None)
+        with context.Pool(workers, initializer=_init_worker, initargs=(goldstandard_file,)) as pool:
+            scored = list(tqdm(pool.imap(_score_team, to_score_files), total=len(to_score_files)))
+
+    for (team_name, _), team_metrics in zip(to_score, scored):
+        all_metrics[team_name] = team_metrics
+        if cache is not None:
+            cache.put(cache_keys[team_name], team_metrics)
+    return {team_name: all_metrics[team_name] for team_name in team_names}
+
+
+def main():
+    """Main function."""
+    args = get_args()
+    profiler = StageProfiler.from_args(args)
+    profiler.start()
+
     # Calculate metrics
-    predictions_path = "./teams_predictions/final"
-    with open('ground_truth_private_test.pkl', 'rb') as fp:
-        gt_all = pickle.load(fp)
-    teams_predictions_files_path = glob(predictions_path + "/*/predictions.csv")
-
-    metrics = {}
-    for team_pred_file in tqdm(teams_predictions_files_path):
-        team_name = team_pred_file.split('/')[-2]
-        pred_submission = pd.read_csv(team_pred_file)
-        all_metrics = calculate_metrics_per_scan(pred_submission, gt_all)
-        metrics[team_name] = all_metrics
-
-    # Bootstrapping process with 100 iterations and 90% resampling
-    final_points = bootstrap_compare(metrics, scan_names=list(gt_all['Cusp'].keys()), alpha=0.001, n_bootstraps=100,
-                                     resample_frac=0.9)
+    with profiler.stage("load_goldstandard"):
+        gt_all = load_goldstandard(args.goldstandard_file)
+    teams_predictions_files_path = glob(args.predictions_dir + "/*/predictions.csv")
+    cache = None
+    if args.cache_dir is not None:
+        cache = MetricsCache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1e6))
+        if args.clear_cache:
+            cache.clear()
+    # CSV parsing and per-scan metrics of every team
+    with profiler.stage("score_teams"):
+        metrics = score_teams(teams_predictions_files_path, gt_all, args.goldstandard_file, workers=args.workers,
+                              cache=cache)
+
+    # Bootstrapping process with 100 iterations by default and 90% resampling
+    with profiler.stage("bootstrap_compare"):
+        final_points = bootstrap_compare(metrics, scan_names=list(gt_all['Cusp'].keys()), alpha=0.001,
+                                         n_bootstraps=args.n_bootstraps, resample_frac=0.9, seed=args.seed,
+                                         workers=args.workers)
     print(final_points)
     # Normalization
     num_teams = len(metrics)
     num_metrics = 2  # mAP, mAR
     num_categories = 6  # "Mesial", "Distal", "Cusp", etc.
 
-    normalized_scores = normalize_points(final_points, num_teams, num_metrics, num_categories, n_bootstraps=100)
+    normalized_scores = normalize_points(final_points, num_teams, num_metrics, num_categories,
+                                         n_bootstraps=args.n_bootstraps)
     # Sort by score in descending order
     ranked_scores = sorted(normalized_scores.items(), key=lambda x: x[1], reverse=True)
 
@@ -130,3 +259,8 @@ if __name__ == "__main__":
     print("-" * 25)
     for team, score in ranked_scores:
         print(f"{team:<15} {score:<10.4f}")
+    profiler.write(args.profile_output)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,9 +7,10 @@
 import argparse
 import json
 import pandas as pd
-import pickle
-from metrics import eval_map, voc_ar
+from goldstandard import load_goldstandard
+from metrics import DIST_THRESH_LIST, calculate_metrics_per_scan, eval_map_sweep, load_predictions, match_map, voc_ar
 import numpy as np
+from profiling import StageProfiler, add_profile_args, profile_filename
 
 
 def get_args():
@@ -18,15 +19,18 @@ def get_args():
     parser.add_argument("-p", "--predictions_file", type=str, required=True)
     parser.add_argument("-g", "--goldstandard_file", type=str, required=True)
     parser.add_argument("-o", "--output", type=str, default="results.json")
+    parser.add_argument("--per_scan_output", type=str, default=None,
+                        help="also write the mAP/mAR of every scan to this JSON file")
+    add_profile_args(parser)
     return parser.parse_args()
 
 
-def score(gt_all, pred_all_map):
+def score(gt_all, pred_all_map, matches=None):
     """
     Calculate metrics for: AP at different distance threshold
+    matches: match_map(pred_all_map, gt_all) if already computed
     """
-    score_dict = {}
-    dist_thresh_list = []
+    dist_thresh_list = DIST_THRESH_LIST
     recall = {
         "Mesial": [],
         "Distal": [],
@@ -35,18 +39,13 @@ def score(gt_all, pred_all_map):
         "OuterPoint": [],
         "FacialPoint": []
     }
-    for i in range(0, 30):
-        dist_thresh = 0.1 * i
-        rec, prec, ap = eval_map(pred_all_map, gt_all, dist_thresh=dist_thresh)
-        score_dict[str(i)] = ap
-        dist_thresh_list.append(dist_thresh)
-        for cat in rec.keys():
-            recall[cat].append(rec[cat][-1])
-        # Collect all values for each class
-    class_values = {'Mesial': [], 'Distal': [], 'Cusp': [], 'InnerPoint': [], 'OuterPoint': [], 'FacialPoint': []}
-    for threshold in score_dict.values():
-        for class_name in class_values.keys():
-            class_values[class_name].append(threshold[class_name])
+    # all distance thresholds in a single matching pass
+    rec, prec, ap = eval_map_sweep(pred_all_map, gt_all, dist_thresh_list, matches=matches)
+    for cat in rec.keys():
+        recall[cat] = list(rec[cat][:, -1])
+    # Collect all values for each class
+    class_values = {class_name: list(ap[class_name]) for class_name in
+                    ['Mesial', 'Distal', 'Cusp', 'InnerPoint', 'OuterPoint', 'FacialPoint']}
 
     # Calculate the mean for each class
     map = {class_name: sum(values) / len(values) for class_name, values in class_values.items()}
@@ -58,6 +57,27 @@ def score(gt_all, pred_all_map):
     return all_metrics
 
 
+def evaluate(gt_all, pred_all_map, per_scan=True, profiler=None):
+    """
+    Leaderboard scores (reformat_scores fields) and per-scan {"mAP", "mAR"} metrics
+    derived from a single matching pass over the predictions
+    per_scan: False to skip the per-scan metrics, returned as None
+    profiler: StageProfiler timing the matching, ap_ar and per_scan_metrics stages
+    """
+    if profiler is None:
+        profiler = StageProfiler()
+    # nearest gt keypoints and greedy matching at every threshold
+    with profiler.stage("matching"):
+        matches = match_map(pred_all_map, gt_all, DIST_THRESH_LIST)
+    # precision/recall curves and AP/AR integration
+    with profiler.stage("ap_ar"):
+        scores = reformat_scores(score(gt_all, pred_all_map, matches=matches))
+    if not per_scan:
+        return scores, None
+    with profiler.stage("per_scan_metrics"):
+        return scores, calculate_metrics_per_scan(pred_all_map, gt_all, matches=matches)
+
+
 def reformat_scores(scores):
     fmt_scores = {}
     metrics_cat = scores['AP']
@@ -82,39 +102,30 @@ def reformat_scores(scores):
 def main():
     """Main function."""
     args = get_args()
+    profiler = StageProfiler.from_args(args)
+    profiler.start()
 
-    pred_submission = pd.read_csv(
-        args.predictions_file
-    )
-
-    pred_all_map = {
-        "Mesial": {},
-        "Distal": {},
-        "Cusp": {},
-        "InnerPoint": {},
-        "OuterPoint": {},
-        "FacialPoint": {}
-    }
+    with profiler.stage("read_csv"):
+        pred_submission = pd.read_csv(
+            args.predictions_file
+        )
+
+    with profiler.stage("load_predictions"):
+        pred_all_map = load_predictions(pred_submission)
 
-    for _, row in pred_submission.iterrows():
-        class_name = row['class']
-        key = row['key']
-        coord = [row['coord_x'], row['coord_y'], row['coord_z']]
-        prob = row['score']
+    with profiler.stage("load_goldstandard"):
+        gold = load_goldstandard(args.goldstandard_file)
 
-        if key not in pred_all_map[class_name]:
-            pred_all_map[class_name][key] = [[coord, prob]]
-        else:
-            pred_all_map[class_name][key].append([coord, prob])
+    scores, scan_metrics = evaluate(gold, pred_all_map, per_scan=bool(args.per_scan_output), profiler=profiler)
 
-    with open(args.goldstandard_file, 'rb') as fp:
-        gold = pickle.load(fp)
+    if args.per_scan_output:
+        with open(args.per_scan_output, "w") as out:
+            out.write(json.dumps(scan_metrics))
 
-    scores = score(gold, pred_all_map)
-    scores = reformat_scores(scores)
     with open(args.output, "w") as out:
         res = {"submission_status": "SCORED", **scores}
         out.write(json.dumps(res))
+    profiler.write(profile_filename(args.output))
 
 
 if __name__ == "__main__":
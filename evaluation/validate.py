@@ -6,7 +6,10 @@ Prediction file should be a 6-col CSV file.
 
 import argparse
 import json
+import numpy as np
 import pandas as pd
+from goldstandard import load_goldstandard_index
+from metrics import DIST_THRESH_LIST
 
 
 COLS = {
@@ -20,98 +23,276 @@ COLS = {
 
 LANDMARKS_TYPE = ["Mesial", "Distal", "Cusp", "InnerPoint", "OuterPoint", "FacialPoint"]
 
+# rows read at once
+CHUNK_SIZE = 1_000_000
+# character limit of the validation errors (for sending email)
+MAX_ERRORS_LENGTH = 500
+# duplicate rows and invalid classes listed in the errors
+MAX_LISTED_VALUES = 10
+# admission limits of the predictions checked against the goldstandard
+MAX_PREDICTIONS = 10_000_000
+MAX_PREDICTIONS_PER_SCAN_CLASS = 10_000
+
 def get_args():
     """Set up command-line interface and get arguments."""
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--predictions_file", type=str, required=True)
     parser.add_argument("-e", "--entity_type", type=str, required=True)
     parser.add_argument("-o", "--output", type=str)
+    parser.add_argument("-g", "--goldstandard_file", type=str, default=None,
+                        help="check the predictions against the scans of this goldstandard before scoring")
+    parser.add_argument("--unknown_keys", choices=["reject", "count"], default="reject",
+                        help="reject predictions for scans missing from the goldstandard, or only count them")
+    parser.add_argument("--max_predictions", type=int, default=MAX_PREDICTIONS)
+    parser.add_argument("--max_predictions_per_scan_class", type=int, default=MAX_PREDICTIONS_PER_SCAN_CLASS)
+    parser.add_argument("--max_cost", type=float, default=None,
+                        help="limit of the estimated scoring cost, see estimate_cost")
     return parser.parse_args()
 
 
-def check_dups(pred):
-    """Check for duplicate mixtures."""
-    duplicates = pred.index.duplicated()
-    if duplicates.any():
+def hash_rows(pred):
+    """64-bit hash of every row, equal rows giving equal hashes."""
+    return pd.util.hash_pandas_object(pred, index=False).to_numpy()
+
+
+def check_dups(dup_rows, n_dups):
+    """Check for duplicate predictions."""
+    if n_dups:
         return (
-            f"Found {duplicates.sum()} duplicate mixture(s): "
-            f"{pred[duplicates].index.to_list()}"
+            f"Found {n_dups} duplicate prediction(s) at row(s): "
+            f"{dup_rows}"
         )
     return ""
 
 
-def check_nan_values(pred, col):
+def check_nan_values(col, missing_probs):
     """Check for NAN predictions."""
-    missing_probs = pred[col].isna().sum()
     if missing_probs:
         return f"'{col}' column contains {missing_probs} NaN value(s)."
     return ""
 
 
-def check_prob_values(pred, col):
+def check_prob_values(col, out_of_range):
     """Check that probabilities are between [0, 1]."""
-    if (pred[col] < 0).any() or (pred[col] > 1).any():
+    if out_of_range:
         return f"'{col}' column should be between [0, 1] inclusive."
     return ""
 
-def check_class_values(pred, col, valid_classes):
+
+def check_class_values(col, invalid_classes):
     """Check if class column contains only valid landmarks."""
-    invalid_classes = pred[~pred[col].isin(valid_classes)]
-    if not invalid_classes.empty:
+    if invalid_classes:
         return (
             f"'{col}' column contains invalid values: "
-            f"{invalid_classes[col].unique().tolist()}"
+            f"{invalid_classes}"
+        )
+    return ""
+
+
+def check_unknown_keys(unknown_keys, n_unknown):
+    """Check that predictions are made for test scans only."""
+    if n_unknown:
+        return (
+            f"Found {n_unknown} prediction(s) for scans that are not in the test set: "
+            f"{unknown_keys}"
         )
     return ""
 
 
-def validate(pred_file):
-    """Validate predictions file against goldstandard."""
-    errors = []
+def check_total_predictions(n_predictions, max_predictions):
+    """Check the number of predictions."""
+    if n_predictions > max_predictions:
+        return f"Submission has more than {max_predictions} predictions."
+    return ""
+
+
+def check_scan_class_predictions(counts, max_per_scan_class):
+    """Check the number of predictions of every (scan, class)."""
+    over = counts[counts > max_per_scan_class]
+    if len(over):
+        (key, category), n = next(iter(over.sort_values(ascending=False).items()))
+        return (
+            f"{len(over)} (scan, class) pair(s) have more than {max_per_scan_class} predictions, "
+            f"e.g. {n} for {key} {category}."
+        )
+    return ""
+
+
+def check_cost(cost, max_cost):
+    """Check the estimated scoring cost."""
+    if max_cost is not None and cost > max_cost:
+        return f"Estimated scoring cost {cost:.3g} exceeds the limit of {max_cost:.3g}."
+    return ""
+
+
+def estimate_cost(counts, gt_index):
+    """Estimated number of elementary operations of scoring: distances of every
+    prediction to the gt keypoints of its (scan, class), plus the greedy matching
+    and precision/recall accumulation of every prediction at every threshold.
+    Input:
+        counts: Series of the number of predictions of every (key, class)
+        gt_index: {(scan, class): number of gt keypoints}
+    """
+    n_gt = np.array([gt_index.get(pair, 0) for pair in counts.index], dtype=np.float64)
+    n_pred = counts.to_numpy(dtype=np.float64)
+    return float(np.sum(n_pred * np.maximum(n_gt, 1)) + len(DIST_THRESH_LIST) * np.sum(n_pred))
+
+
+def validate(pred_file, chunksize=CHUNK_SIZE, max_errors_length=MAX_ERRORS_LENGTH, gt_index=None,
+             unknown_keys="reject", max_predictions=MAX_PREDICTIONS,
+             max_per_scan_class=MAX_PREDICTIONS_PER_SCAN_CLASS, max_cost=None, stats=None):
+    """Validate predictions file against goldstandard.
+
+    The file is read in chunks of `chunksize` rows. Duplicates are found
+    across chunks through a sorted array of the 64-bit hashes of the distinct
+    rows read, 8 bytes per row, which every chunk is merged into. Reading
+    stops as soon as the errors found fill `max_errors_length` characters,
+    or past `max_predictions` rows, which are refused and bound the memory
+    used.
+
+    With a goldstandard index (see goldstandard.load_goldstandard_index),
+    submissions that cannot be scored cheaply are also refused before
+    scoring: predictions for unknown scans (rejected, or only counted with
+    unknown_keys="count"), more than `max_per_scan_class` predictions for a
+    (scan, class), or an estimate_cost above `max_cost`. The counts are
+    stored in the `stats` dict when one is given.
+    """
+    seen_hashes = np.empty(0, dtype=np.uint64)
+    dup_rows = []
+    n_dups = 0
+    missing = {"coord_x": 0, "coord_y": 0, "coord_z": 0}
+    out_of_range = False
+    invalid_classes = []
+    n_predictions = 0
+    # number of predictions of every (key, class)
+    counts = None
+    gt_keys = None if gt_index is None else pd.Index(sorted({scan_name for scan_name, _ in gt_index}))
+    unknown = []
+    n_unknown = 0
+
+    def errors():
+        return [
+            check_dups(dup_rows, n_dups),
+            check_class_values("class", invalid_classes),
+            *[check_nan_values(col, missing_probs) for col, missing_probs in missing.items()],
+            check_prob_values("score", out_of_range),
+            check_unknown_keys(unknown, n_unknown) if unknown_keys == "reject" else "",
+            check_total_predictions(n_predictions, max_predictions),
+        ]
 
     try:
-        pred = pd.read_csv(
+        reader = pd.read_csv(
             pred_file,
             usecols=COLS,
             dtype=COLS,
             float_precision="high",
-            sep=','
+            sep=',',
+            chunksize=chunksize
         )
+        with reader:
+            for pred in reader:
+                hashes = hash_rows(pred)
+                order = np.argsort(hashes, kind="stable")
+                sorted_hashes = hashes[order]
+                # duplicates of an earlier chunk, then inside the chunk
+                position = np.searchsorted(seen_hashes, sorted_hashes)
+                if len(seen_hashes):
+                    seen = seen_hashes[np.minimum(position, len(seen_hashes) - 1)] == sorted_hashes
+                else:
+                    seen = np.zeros(len(pred), dtype=bool)
+                repeated = np.zeros(len(pred), dtype=bool)
+                repeated[1:] = sorted_hashes[1:] == sorted_hashes[:-1]
+                duplicates = np.zeros(len(pred), dtype=bool)
+                duplicates[order] = seen | repeated
+                if duplicates.any():
+                    n_dups += int(duplicates.sum())
+                    dup_rows.extend(pred.index[duplicates][:MAX_LISTED_VALUES - len(dup_rows)].to_list())
+                # merged in linear time, the sorted positions of the new hashes are known already
+                new = ~(seen | repeated)
+                seen_hashes = np.insert(seen_hashes, position[new], sorted_hashes[new])
+
+                if len(invalid_classes) < MAX_LISTED_VALUES:
+                    for value in pred.loc[~pred["class"].isin(LANDMARKS_TYPE), "class"].unique().tolist():
+                        if value not in invalid_classes and len(invalid_classes) < MAX_LISTED_VALUES:
+                            invalid_classes.append(value)
+                for col in missing:
+                    missing[col] += int(pred[col].isna().sum())
+                out_of_range = out_of_range or bool((pred["score"] < 0).any() or (pred["score"] > 1).any())
+
+                n_predictions += len(pred)
+                if gt_index is not None:
+                    # one grouped pass per chunk
+                    chunk_counts = pred.groupby(["key", "class"], sort=False).size()
+                    counts = chunk_counts if counts is None else counts.add(chunk_counts, fill_value=0)
+                    is_unknown = ~pred["key"].isin(gt_keys)
+                    if is_unknown.any():
+                        n_unknown += int(is_unknown.sum())
+                        for value in pred.loc[is_unknown, "key"].unique()[:MAX_LISTED_VALUES].tolist():
+                            if value not in unknown and len(unknown) < MAX_LISTED_VALUES:
+                                unknown.append(value)
+
+                # the seen hashes grow with every row read
+                if n_predictions > max_predictions:
+                    break
+                # no need to read further once the reported errors are truncated anyway
+                if len("\n".join(filter(None, errors()))) > max_errors_length:
+                    break
     except ValueError:
-        errors.append(
+        return [
             "Invalid prediction file headers and/or column types. "
             f"Expecting: {str(COLS)}."
-        )
-    else:
-        errors.append(check_dups(pred))
-        errors.append(check_class_values(pred, "class", LANDMARKS_TYPE))
-        errors.append(check_nan_values(pred, "coord_x"))
-        errors.append(check_nan_values(pred, "coord_y"))
-        errors.append(check_nan_values(pred, "coord_z"))
-        errors.append(check_prob_values(pred, "score"))
-    return errors
+        ]
+    if gt_index is None:
+        return errors()
+
+    if counts is None:
+        counts = pd.Series(dtype=np.int64)
+    counts = counts.astype(np.int64)
+    cost = estimate_cost(counts, gt_index)
+    if stats is not None:
+        stats.update({
+            "n_predictions": n_predictions,
+            "n_unknown_key_predictions": n_unknown,
+            "max_predictions_per_scan_class": int(counts.max()) if len(counts) else 0,
+            "estimated_scoring_cost": cost,
+        })
+    return errors() + [
+        check_scan_class_predictions(counts, max_per_scan_class),
+        check_cost(cost, max_cost),
+    ]
 
 
 def main():
     """Main function."""
     args = get_args()
     entity_type = args.entity_type.split(".")[-1]
+    # admission counts, annotated along with the status
+    stats = {}
 
     if entity_type != "DockerRepository":
         invalid_reasons = [f"Submission must be a File, not {entity_type}."]
     else:
+        gt_index = None
+        if args.goldstandard_file:
+            gt_index = load_goldstandard_index(args.goldstandard_file)
         invalid_reasons = validate(
-            pred_file=args.predictions_file
+            pred_file=args.predictions_file,
+            gt_index=gt_index,
+            unknown_keys=args.unknown_keys,
+            max_predictions=args.max_predictions,
+            max_per_scan_class=args.max_predictions_per_scan_class,
+            max_cost=args.max_cost,
+            stats=stats
         )
 
     invalid_reasons = "\n".join(filter(None, invalid_reasons))
     status = "INVALID" if invalid_reasons else "VALIDATED"
 
     # truncate validation errors if >500 (character limit for sending email)
-    if len(invalid_reasons) > 500:
-        invalid_reasons = invalid_reasons[:496] + "..."
+    if len(invalid_reasons) > MAX_ERRORS_LENGTH:
+        invalid_reasons = invalid_reasons[:MAX_ERRORS_LENGTH - 4] + "..."
     res = json.dumps(
-        {"submission_status": status, "submission_errors": invalid_reasons}
+        {"submission_status": status, "submission_errors": invalid_reasons, **stats}
     )
 
     if args.output:
@@ -1,14 +1,26 @@
 """Run training synthetic docker models"""
 from __future__ import print_function
 import argparse
+import calendar
+import codecs
+import collections
+import csv
+import fcntl
+import fnmatch
 import getpass
+import gzip
+import json
 import os
+import shutil
+import subprocess
 import tarfile
+import threading
 import time
 
 import docker
 import synapseclient
 from docker.types import DeviceRequest
+from docker.utils import parse_bytes
 
 
 
@@ -23,26 +35,76 @@ def create_log_file(log_filename, log_text=None):
             log_file.write("No Logs")
 
 
-def get_last_lines(log_filename, n=5):
+def get_last_lines(log_filename, n=5, block_size=1 << 16):
     """Get last N lines of log file (default=5)."""
-    lines = 0
     with open(log_filename, "rb") as f:
-        try:
-            f.seek(-2, os.SEEK_END)
-            # Keep reading, starting at the end, until n lines is read.
+        size = f.seek(0, os.SEEK_END)
+        # The last 3 bytes (trailing newline) are not searched, and the whole
+        # file is returned if it holds fewer than n newlines.
+        start = max(size - 2, 0) if n <= 0 else 0
+        end = max(size - 3, 0)
+        lines = 0
+        while end > 0 and lines < n:
+            block_start = max(end - block_size, 0)
+            f.seek(block_start)
+            block = f.read(end - block_start)
+            newline = len(block)
             while lines < n:
-                f.seek(-2, os.SEEK_CUR)
-                if f.read(1) == b"\n":
-                    lines += 1
-        except OSError:
-            # If file only contains one line, then only read that one
-            # line.  This exception will probably never occur, but
-            # adding it in, just in case.
-            f.seek(0)
+                newline = block.rfind(b"\n", 0, newline)
+                if newline < 0:
+                    break
+                lines += 1
+            if lines == n:
+                start = block_start + newline + 1
+            end = block_start
+        f.seek(start)
         last_lines = f.read().decode()
     return last_lines
 
 
+class LogRetention:
+    """Head and tail of a log stream kept in bounded memory.
+
+    The first `head_bytes` characters are kept as they are, the last
+    `tail_bytes` ones in a ring buffer of chunks; what falls in between is
+    only counted. The defaults keep the retained log below the 50 KB above
+    which store_log_file would cut it down to its last lines.
+    """
+
+    def __init__(self, head_bytes=10000, tail_bytes=39000):
+        self.head_bytes = head_bytes
+        self.tail_bytes = tail_bytes
+        self.head = ""
+        self.tail = collections.deque()
+        self.tail_size = 0
+        self.skipped = 0
+
+    def append(self, text):
+        """Add text at the end of the log."""
+        if len(self.head) < self.head_bytes:
+            taken = self.head_bytes - len(self.head)
+            self.head += text[:taken]
+            text = text[taken:]
+        if not text:
+            return
+        self.tail.append(text)
+        self.tail_size += len(text)
+        while self.tail_size > self.tail_bytes:
+            excess = self.tail_size - self.tail_bytes
+            if len(self.tail[0]) <= excess:
+                dropped = len(self.tail.popleft())
+            else:
+                self.tail[0] = self.tail[0][excess:]
+                dropped = excess
+            self.tail_size -= dropped
+            self.skipped += dropped
+
+    def text(self):
+        """Retained log, with a marker where the middle was dropped."""
+        marker = f"\n... [{self.skipped} characters skipped] ...\n" if self.skipped else ""
+        return self.head + marker + "".join(self.tail)
+
+
 def store_log_file(syn, log_filename, parentid, store=True):
     """Store log file"""
     statinfo = os.stat(log_filename)
@@ -59,9 +121,269 @@ def store_log_file(syn, log_filename, parentid, store=True):
                 print(err)
 
 
-def remove_docker_container(container_name):
+class LogPump:
+    """Follow the logs of a running container and upload them incrementally.
+
+    New output is added to a LogRetention as it arrives through
+    `container.logs(stream=True, follow=True, timestamps=True)`. Once
+    `upload_bytes` new bytes are pending, or `upload_interval` seconds went
+    by since the last upload with new bytes pending, the retained head and
+    tail are written to `log_filename` and `upload()` is called. If the
+    stream breaks or fails while the container is still running, it is
+    reopened from the daemon timestamp of the last line read, every
+    `reconnect_interval` seconds, and lines already read are skipped. After
+    `max_reconnects` failed attempts in a row the logs are given up, but the
+    thread still polls the container until it stops. Only the container's
+    `logs`, `reload` and `status` are used, so a fake container can drive it.
+    """
+
+    def __init__(self, container, log_filename, upload, upload_interval=60, upload_bytes=1 << 20,
+                 retention=None, reconnect_interval=5, max_reconnects=12):
+        self.container = container
+        self.log_filename = log_filename
+        self.upload = upload
+        self.upload_interval = upload_interval
+        self.upload_bytes = upload_bytes
+        self.retention = retention if retention is not None else LogRetention()
+        self.reconnect_interval = reconnect_interval
+        self.max_reconnects = max_reconnects
+        self.pending_bytes = 0
+        self.last_upload = time.monotonic()
+        # (seconds, nanoseconds) daemon timestamp of the last line, to resume the stream if it breaks
+        self.last_timestamp = None
+        # start of a line whose end has not arrived yet
+        self._partial = b""
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._follow, daemon=True)
+
+    def _append(self, chunk):
+        text = self._decoder.decode(chunk).encode("ascii", "ignore").decode("ascii")
+        with self._lock:
+            self.retention.append(text)
+            self.pending_bytes += len(text)
+
+    @staticmethod
+    def parse_timestamp(stamp):
+        """(seconds, nanoseconds) of an RFC 3339 timestamp like 2024-05-01T12:00:00.123456789Z, or None"""
+        try:
+            stamp = stamp.decode("ascii").rstrip("Z")
+            date, _, fraction = stamp.partition(".")
+            seconds = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+            return seconds, int(fraction[:9].ljust(9, "0"))
+        except (UnicodeDecodeError, ValueError):
+            return None
+
+    def _append_line(self, line):
+        stamp, _, text = line.partition(b" ")
+        timestamp = self.parse_timestamp(stamp)
+        if timestamp is None:
+            text = line
+        elif self.last_timestamp is not None and timestamp <= self.last_timestamp:
+            # sent again by a stream resumed from the last timestamp
+            return
+        else:
+            self.last_timestamp = timestamp
+        self._append(text)
+
+    def _read(self, chunk):
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self._append_line(line + b"\n")
+
+    def _since(self):
+        if self.last_timestamp is None:
+            return None
+        seconds, nanoseconds = self.last_timestamp
+        # a float is rounded to a fraction of a microsecond: start a little earlier, repeated lines are skipped
+        return seconds + nanoseconds / 1e9 - 1e-6
+
+    def _follow(self):
+        failures = 0
+        streaming = True
+        while True:
+            received = False
+            if streaming:
+                try:
+                    for chunk in self.container.logs(stream=True, follow=True, timestamps=True,
+                                                     since=self._since()):
+                        received = True
+                        failures = 0
+                        self._read(chunk)
+                except Exception as err:
+                    print(f"Log stream of the container failed: {err}")
+                    failures += 1
+            # the stream also ends when the connection drops, resume if still running
+            try:
+                self.container.reload()
+                running = self.container.status == "running"
+            except docker.errors.NotFound:
+                running = False
+            except Exception as err:
+                print(f"Unable to get the container status: {err}")
+                failures += 1
+                running = True
+            if not running:
+                # output that did not end with a newline
+                if self._partial:
+                    self._append_line(self._partial)
+                    self._partial = b""
+                return
+            # a line cut by the broken stream is sent again whole
+            self._partial = b""
+            if streaming and failures >= self.max_reconnects:
+                print("Giving up following the container logs, waiting for the container to stop")
+                streaming = False
+            if not streaming or failures or not received:
+                time.sleep(self.reconnect_interval)
+
+    def start(self):
+        """Start following the logs in a background thread."""
+        self._thread.start()
+
+    def flush(self, force=False):
+        """Upload the log file if the debounce allows it, or if `force` is set."""
+        with self._lock:
+            due = (self.pending_bytes >= self.upload_bytes or
+                   time.monotonic() - self.last_upload >= self.upload_interval)
+            if not (force or (self.pending_bytes and due)):
+                return
+            log_text = self.retention.text()
+            if log_text:
+                create_log_file(self.log_filename, log_text)
+            self.upload()
+            self.pending_bytes = 0
+            self.last_upload = time.monotonic()
+
+    def wait(self, poll_interval=1):
+        """Block until the container has stopped and its logs are read, uploading on the way."""
+        while self._thread.is_alive():
+            self._thread.join(poll_interval)
+            self.flush()
+        self.flush(force=True)
+
+
+class StatsSampler:
+    """Record the resource usage of a running container
+
+    Samples of `container.stats(stream=True, decode=True)` are read in a
+    background thread and kept at most every `interval` seconds as
+    (elapsed seconds, CPU %, memory, I/O read bytes, I/O write bytes), memory
+    being the usage minus the page cache. The peak memory is the largest such
+    usage of all the entries read, kept or not; the cgroup v1 high-water mark,
+    which counts the page cache, is reported separately. Only the
+    container's `stats`, `reload` and `attrs` are used, so a fake stats
+    stream can drive it.
+    """
+
+    FIELDS = ["elapsed", "cpu_percent", "memory", "io_read", "io_write"]
+
+    def __init__(self, container, interval=5):
+        self.container = container
+        self.interval = interval
+        self.samples = []
+        self.peak_memory = 0
+        self.max_usage = None
+        self.memory_limit = None
+        self.start_time = None
+        self.end_time = None
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    @staticmethod
+    def parse(stats):
+        """(CPU %, memory, I/O read bytes, I/O write bytes, cgroup v1 max usage or None, memory limit)
+        of a stats entry"""
+        cpu_stats = stats.get("cpu_stats", {})
+        precpu_stats = stats.get("precpu_stats", {})
+        cpu_delta = (cpu_stats.get("cpu_usage", {}).get("total_usage", 0) -
+                     precpu_stats.get("cpu_usage", {}).get("total_usage", 0))
+        system_delta = cpu_stats.get("system_cpu_usage", 0) - precpu_stats.get("system_cpu_usage", 0)
+        online_cpus = cpu_stats.get("online_cpus") or len(cpu_stats.get("cpu_usage", {}).get("percpu_usage") or [1])
+        cpu_percent = cpu_delta / system_delta * online_cpus * 100 if system_delta > 0 else 0.
+
+        memory_stats = stats.get("memory_stats", {})
+        usage = memory_stats.get("usage", 0)
+        # page cache: "inactive_file" with cgroup v2, "cache" with v1
+        cache = memory_stats.get("stats", {}).get("inactive_file", memory_stats.get("stats", {}).get("cache", 0))
+        memory = max(usage - cache, 0)
+
+        io_read = io_write = 0
+        for entry in stats.get("blkio_stats", {}).get("io_service_bytes_recursive") or []:
+            if entry.get("op", "").lower() == "read":
+                io_read += entry.get("value", 0)
+            elif entry.get("op", "").lower() == "write":
+                io_write += entry.get("value", 0)
+        return cpu_percent, memory, io_read, io_write, memory_stats.get("max_usage"), memory_stats.get("limit")
+
+    def _sample(self):
+        last_kept = None
+        try:
+            for stats in self.container.stats(stream=True, decode=True):
+                now = time.monotonic()
+                cpu_percent, memory, io_read, io_write, max_usage, limit = self.parse(stats)
+                self.peak_memory = max(self.peak_memory, memory)
+                if max_usage is not None:
+                    self.max_usage = max(self.max_usage or 0, max_usage)
+                self.memory_limit = limit or self.memory_limit
+                if last_kept is None or now - last_kept >= self.interval:
+                    self.samples.append((round(now - self.start_time, 3), round(cpu_percent, 2), memory,
+                                         io_read, io_write))
+                    last_kept = now
+        except Exception as err:
+            print(f"Unable to read container stats: {err}")
+
+    def start(self):
+        """Start sampling in a background thread"""
+        self.start_time = time.monotonic()
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Wait for the stats stream to end with the container"""
+        self._thread.join(timeout)
+        self.end_time = time.monotonic()
+
+    def summary(self):
+        """Peak and mean usage, wall time and exit state of the container"""
+        state = {}
+        try:
+            self.container.reload()
+            state = self.container.attrs.get("State", {})
+        except Exception:
+            pass
+        cpu = [sample[1] for sample in self.samples]
+        last = self.samples[-1] if self.samples else (0, 0, 0, 0, 0)
+        return {
+            "wall_time": round(self.end_time - self.start_time, 3),
+            "cpu_percent_mean": round(sum(cpu) / len(cpu), 2) if cpu else 0.,
+            "cpu_percent_max": max(cpu, default=0.),
+            "memory_peak": self.peak_memory,
+            # with the page cache, cgroup v1 only
+            "memory_max_usage": self.max_usage,
+            "memory_limit": self.memory_limit,
+            "io_read": last[3],
+            "io_write": last[4],
+            "oom_killed": bool(state.get("OOMKilled", False)),
+            "exit_code": state.get("ExitCode"),
+            "samples": len(self.samples),
+        }
+
+    def write(self, prefix):
+        """Write <prefix>_stats.json (summary) and <prefix>_stats.csv (time series), returns the summary"""
+        summary = self.summary()
+        with open(prefix + "_stats.json", "w") as stats_file:
+            json.dump(summary, stats_file, indent=2)
+        with open(prefix + "_stats.csv", "w", newline="") as stats_file:
+            writer = csv.writer(stats_file)
+            writer.writerow(self.FIELDS)
+            writer.writerows(self.samples)
+        return summary
+
+
+def remove_docker_container(container_name, client=None):
     """Remove docker container"""
-    client = docker.from_env()
+    if client is None:
+        client = docker.from_env()
     try:
         cont = client.containers.get(container_name)
         cont.stop()
@@ -70,89 +392,306 @@ def remove_docker_container(container_name):
         print("Unable to remove container")
 
 
-def remove_docker_image(image_name):
+def remove_docker_image(image_name, client=None):
     """Remove docker image"""
-    client = docker.from_env()
+    if client is None:
+        client = docker.from_env()
     try:
         client.images.remove(image_name, force=True)
     except Exception:
         print("Unable to remove image")
 
 
-def tar(directory, tar_filename):
+class ImageCache:
+    """Keep recently used submission images instead of removing them
+
+    Images released after a run stay on disk, and the least recently used
+    ones are removed once their total size exceeds `quota_bytes`. A quota of
+    0 removes every image as soon as it is released, like
+    remove_docker_image. Sizes and last uses are kept in `state_file`,
+    locked while updated, so that the runs of several processes share one
+    cache. Images used by a running container are never removed. Images
+    pulled ahead of their runs by prefetch() are recorded and evicted like
+    the others, and are only pulled while the cache is under its quota.
+    """
+
+    def __init__(self, client, quota_bytes=0, state_file=None):
+        self.client = client
+        self.quota_bytes = quota_bytes
+        if state_file is None:
+            state_file = os.path.join(os.path.expanduser("~"), ".cache", "docker_image_cache.json")
+        self.state_file = state_file
+        os.makedirs(os.path.dirname(os.path.abspath(state_file)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._in_use = collections.Counter()
+        # images to pull in the background, every image ever queued, and the
+        # images pulled for runs that have not started yet
+        self._prefetch_queue = collections.deque()
+        self._prefetched = set()
+        self._awaiting_run = set()
+        self._prefetch_thread = None
+
+    def _update_state(self, update):
+        """Apply update(state) to the state file, under an exclusive lock"""
+        with self._lock, open(self.state_file, "a+") as state_fp:
+            fcntl.flock(state_fp, fcntl.LOCK_EX)
+            state_fp.seek(0)
+            try:
+                state = json.load(state_fp)
+            except ValueError:
+                state = {}
+            result = update(state)
+            state_fp.seek(0)
+            state_fp.truncate()
+            json.dump(state, state_fp)
+            return result
+
+    def acquire(self, image_name):
+        """Mark an image as used by a run starting now"""
+        with self._lock:
+            self._in_use[image_name] += 1
+            self._awaiting_run.discard(image_name)
+
+    def release(self, image_name):
+        """Mark the end of a run using an image, then evict images over quota"""
+        with self._lock:
+            self._in_use[image_name] -= 1
+        try:
+            size = self.client.images.get(image_name).attrs["Size"]
+        except Exception:
+            size = None
+
+        def record(state):
+            if size is None:
+                state.pop(image_name, None)
+            else:
+                state[image_name] = {"size": size, "last_used": time.time()}
+        self._update_state(record)
+        self.evict()
+
+    def disk_usage(self):
+        """Total size of the cached images"""
+        return self._update_state(lambda state: sum(entry["size"] for entry in state.values()))
+
+    def evict(self):
+        """Remove least recently used images until the cache fits in its quota
+
+        Images prefetched for runs that have not started yet go last, those
+        of the furthest runs first.
+        """
+        def eviction_order(item):
+            image_name, entry = item
+            if image_name in self._awaiting_run:
+                return 1, -entry["last_used"]
+            return 0, entry["last_used"]
+
+        def evict_lru(state):
+            total = sum(entry["size"] for entry in state.values())
+            order = sorted(state.items(), key=eviction_order)
+            for image_name, entry in order:
+                if total <= self.quota_bytes:
+                    break
+                if self._in_use[image_name] > 0:
+                    continue
+                try:
+                    # not forced: fails if a container of another run still uses it
+                    self.client.images.remove(image_name)
+                except docker.errors.ImageNotFound:
+                    pass
+                except Exception:
+                    print("Unable to remove image")
+                    continue
+                total -= entry["size"]
+                del state[image_name]
+                self._awaiting_run.discard(image_name)
+        self._update_state(evict_lru)
+
+    def _pull(self, image_name):
+        """Pull an image missing from the host if the cache has room, and record it"""
+        if self.disk_usage() >= self.quota_bytes:
+            return
+        try:
+            self.client.images.get(image_name)
+            return
+        except docker.errors.ImageNotFound:
+            pass
+        try:
+            size = self.client.images.pull(image_name).attrs["Size"]
+        except Exception as err:
+            print(f"Unable to prefetch {image_name}: {err}")
+            return
+
+        def record(state):
+            state[image_name] = {"size": size, "last_used": time.time()}
+        with self._lock:
+            if not self._in_use[image_name]:
+                self._awaiting_run.add(image_name)
+        self._update_state(record)
+        self.evict()
+
+    def _pull_queued(self):
+        while True:
+            with self._lock:
+                if not self._prefetch_queue:
+                    self._prefetch_thread = None
+                    return
+                image_name = self._prefetch_queue.popleft()
+            self._pull(image_name)
+
+    def prefetch(self, image_names):
+        """Pull images of the next queued runs, one at a time in a background thread
+
+        Images already queued once are skipped, so this can be called with a
+        sliding window of the queue. Returns the pulling thread, or None if
+        there is nothing to pull.
+        """
+        with self._lock:
+            for image_name in image_names:
+                if image_name not in self._prefetched:
+                    self._prefetched.add(image_name)
+                    self._prefetch_queue.append(image_name)
+            if self._prefetch_queue and self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(target=self._pull_queued, daemon=True)
+                self._prefetch_thread.start()
+            return self._prefetch_thread
+
+
+def _is_gzip(tar_filename):
+    return tar_filename.endswith((".gz", ".tgz"))
+
+
+def _pigz(*args):
+    """pigz command with its arguments, None if pigz is not installed"""
+    pigz = shutil.which("pigz")
+    return [pigz, *args] if pigz else None
+
+
+def tar(directory, tar_filename, exclude=(), threads=None, compresslevel=6):
     """Tar all files in a directory
 
+    The archive is written as a stream, gzip-compressed when tar_filename
+    ends with .gz or .tgz, by pigz on `threads` threads (all cores by
+    default) when it is installed, else by the gzip module.
+
     Args:
         directory: Directory path to files to tar
         tar_filename:  tar file path
+        exclude: glob patterns of paths, or file names, to leave out
     """
-    with tarfile.open(tar_filename, "w") as tar_o:
-        tar_o.add(directory)
+    tar_path = os.path.abspath(tar_filename)
+
+    def keep(tarinfo):
+        # never archive the archive itself, it may be written in directory
+        if os.path.abspath(os.path.join("/", tarinfo.name)) == tar_path or \
+                os.path.abspath(tarinfo.name) == tar_path:
+            return None
+        for pattern in exclude:
+            if fnmatch.fnmatch(tarinfo.name, pattern) or fnmatch.fnmatch(os.path.basename(tarinfo.name), pattern):
+                return None
+        return tarinfo
+
+    pigz = _pigz("-c", f"-{compresslevel}", "-p", str(threads or os.cpu_count())) if _is_gzip(tar_filename) else None
+    if pigz is None:
+        if _is_gzip(tar_filename):
+            tar_file = gzip.open(tar_filename, "wb", compresslevel=compresslevel)
+        else:
+            tar_file = open(tar_filename, "wb")
+        with tar_file, tarfile.open(fileobj=tar_file, mode="w|") as tar_o:
+            tar_o.add(directory, filter=keep)
+    else:
+        with open(tar_filename, "wb") as tar_file:
+            proc = subprocess.Popen(pigz, stdin=subprocess.PIPE, stdout=tar_file)
+            with tarfile.open(fileobj=proc.stdin, mode="w|") as tar_o:
+                tar_o.add(directory, filter=keep)
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise Exception(f"pigz failed to compress {tar_filename}")
     # TODO: Potentially add code to remove all files that were zipped.
 
 
-def untar(directory, tar_filename):
+def _safe_member(member, directory):
+    """Refuse members escaping directory, links pointing outside of it and device files"""
+    root = os.path.realpath(directory)
+    target = os.path.realpath(os.path.join(root, member.name))
+    if os.path.commonpath([root, target]) != root:
+        raise Exception(f"Refusing to extract {member.name} outside of {directory}")
+    if member.issym() or member.islnk():
+        link_base = os.path.dirname(target) if member.issym() else root
+        link_target = os.path.realpath(os.path.join(link_base, member.linkname))
+        if os.path.isabs(member.linkname) or os.path.commonpath([root, link_target]) != root:
+            raise Exception(f"Refusing to extract link {member.name} -> {member.linkname}")
+    if member.isdev():
+        raise Exception(f"Refusing to extract device file {member.name}")
+    return member
+
+
+def untar(directory, tar_filename, threads=None):
     """Untar a tar file into a directory
 
+    Members are extracted one by one as the archive is read, gzip archives
+    being decompressed by pigz when it is installed. Members that would
+    land outside of directory (absolute paths, "..", links) or are device
+    files make the extraction fail.
+
     Args:
         directory: Path to directory to untar files
         tar_filename:  tar file path
     """
-    with tarfile.open(tar_filename, "r") as tar_o:
-        tar_o.extractall(path=directory)
-
-
-def main(syn, args):
-    """Run docker model"""
-    if args.status == "INVALID":
-        raise Exception("Docker image is invalid")
-
+    # the "data" filter of Python >= 3.11.4 also drops setuid bits and unsafe modes
+    data_filter = hasattr(tarfile, "data_filter")
+
+    def extract(tar_o):
+        for member in tar_o:
+            member = _safe_member(member, directory)
+            if data_filter:
+                tar_o.extract(member, path=directory, filter="data")
+            else:
+                tar_o.extract(member, path=directory, set_attrs=False)
+
+    pigz = _pigz("-dc", "-p", str(threads or os.cpu_count())) if _is_gzip(tar_filename) else None
+    if pigz is None:
+        with tarfile.open(tar_filename, "r|*") as tar_o:
+            extract(tar_o)
+    else:
+        with open(tar_filename, "rb") as tar_file:
+            proc = subprocess.Popen(pigz, stdin=tar_file, stdout=subprocess.PIPE)
+            with tarfile.open(fileobj=proc.stdout, mode="r|") as tar_o:
+                extract(tar_o)
+            proc.stdout.close()
+            if proc.wait() != 0:
+                raise Exception(f"pigz failed to decompress {tar_filename}")
+
+
+def get_docker_client(synapse_config):
+    """Docker client logged in to the Synapse registry"""
     # The new toil version doesn't seem to pull the docker config file from
     # .docker/config.json...
     # client = docker.from_env()
     client = docker.DockerClient(base_url='unix://var/run/docker.sock')
     config = synapseclient.Synapse().getConfigFile(
-        configPath=args.synapse_config
+        configPath=synapse_config
     )
     authen = dict(config.items("authentication"))
     client.login(username=authen['username'],
                  password=authen['password'],
                  registry="https://docker.synapse.org")
                  # dockercfg_path=".docker/config.json")
+    return client
 
-    print(getpass.getuser())
-
-    # Add docker.config file
-    docker_image = args.docker_repository + "@" + args.docker_digest
 
-    # These are the volumes that you want to mount onto your docker container
-    # output_dir = os.path.join(os.getcwd(), "output")
-    output_dir = os.getcwd()
-    # os.makedirs(output_dir, exist_ok=True, mode=777)
-    input_dir = args.input_dir
-
-    print("mounting volumes")
-    # These are the locations on the docker that you want your mounted
-    # volumes to be + permissions in docker (ro, rw)
-    # It has to be in this format '/output:rw'
-    mounted_volumes = {output_dir: '/output:rw',
-                       input_dir: '/input:ro'}
-    # All mounted volumes here in a list
-    all_volumes = [output_dir, input_dir]
-    # Mount volumes
-    volumes = {}
-    for vol in all_volumes:
-        volumes[vol] = {'bind': mounted_volumes[vol].split(":")[0],
-                        'mode': mounted_volumes[vol].split(":")[1]}
+def get_container(client, submissionid, docker_image, volumes, mem_limit='6g', nano_cpus=None,
+                  device_requests=None, runtime='nvidia'):
+    """Reconnect to the container of a submission or run it
 
-    # GPU support: Add device requests for GPUs
-    device_requests = [DeviceRequest(count=-1, capabilities=[['gpu']])]
+    Returns the container, None if it could not be started, and the error
+    raised when starting it.
+    """
     # Look for if the container exists already, if so, reconnect
     print("checking for containers")
     container = None
     errors = None
     for cont in client.containers.list(all=True, ignore_removed=True):
-        if args.submissionid in cont.name:
+        if cont.name == submissionid:
             # Must remove container if the container wasn't killed properly
             if cont.status == "exited":
                 cont.remove()
@@ -165,47 +704,104 @@ def main(syn, args):
         try:
             container = client.containers.run(docker_image,
                                               detach=True, volumes=volumes,
-                                              name=args.submissionid,
+                                              name=submissionid,
                                               network_disabled=True,
-                                              mem_limit='6g', stderr=True,
-                                              runtime = 'nvidia',  # Specify runtime as nvidia
-                                              device_requests = device_requests  # Specify GPU devices
-                                                )
+                                              mem_limit=mem_limit, nano_cpus=nano_cpus, stderr=True,
+                                              runtime=runtime,  # nvidia runtime for GPU support
+                                              device_requests=device_requests  # Specify GPU devices
+                                              )
         except docker.errors.APIError as err:
-            remove_docker_container(args.submissionid)
+            remove_docker_container(submissionid, client=client)
             errors = str(err) + "\n"
+    return container, errors
 
-    print("creating logfile")
-    # Create the logfile
-    log_filename = args.submissionid + "_log.txt"
-    # Open log file first
-    open(log_filename, 'w').close()
-
-    # If the container doesn't exist, there are no logs to write out and
-    # no container to remove
-    if container is not None:
-        # Check if container is still running
-        while container in client.containers.list(ignore_removed=True):
-            log_text = container.logs()
-            create_log_file(log_filename, log_text=log_text)
-            store_log_file(syn, log_filename, args.parentid, store=args.store)
-            time.sleep(60)
-        # Must run again to make sure all the logs are captured
-        log_text = container.logs()
-        create_log_file(log_filename, log_text=log_text)
-        store_log_file(syn, log_filename, args.parentid, store=args.store)
-        # Remove container and image after being done
-        container.remove()
 
-    statinfo = os.stat(log_filename)
+def run_submission(syn, client, args, output_dir=None, mem_limit='6g', nano_cpus=None, device_requests=None,
+                   runtime='nvidia', image_cache=None):
+    """Run the docker image of a submission and check its predictions
 
-    if statinfo.st_size == 0:
-        create_log_file(log_filename, log_text=errors)
-        store_log_file(syn, log_filename, args.parentid, store=args.store)
+    By default the container gets all GPUs and writes to the current
+    directory, and its image is removed afterwards unless an ImageCache
+    keeps it.
+    """
+    if args.status == "INVALID":
+        raise Exception("Docker image is invalid")
 
-    print("finished training")
-    # Try to remove the image
-    remove_docker_image(docker_image)
+    # Add docker.config file
+    docker_image = args.docker_repository + "@" + args.docker_digest
+
+    # These are the volumes that you want to mount onto your docker container
+    # output_dir = os.path.join(os.getcwd(), "output")
+    if output_dir is None:
+        output_dir = os.getcwd()
+    # os.makedirs(output_dir, exist_ok=True, mode=777)
+    input_dir = args.input_dir
+
+    print("mounting volumes")
+    # These are the locations on the docker that you want your mounted
+    # volumes to be + permissions in docker (ro, rw)
+    # It has to be in this format '/output:rw'
+    mounted_volumes = {output_dir: '/output:rw',
+                       input_dir: '/input:ro'}
+    # All mounted volumes here in a list
+    all_volumes = [output_dir, input_dir]
+    # Mount volumes
+    volumes = {}
+    for vol in all_volumes:
+        volumes[vol] = {'bind': mounted_volumes[vol].split(":")[0],
+                        'mode': mounted_volumes[vol].split(":")[1]}
+
+    if image_cache is not None:
+        image_cache.acquire(docker_image)
+    # the image is released however the run ends, or the cache would keep it forever
+    try:
+        if device_requests is None and runtime == 'nvidia':
+            # GPU support: Add device requests for GPUs
+            device_requests = [DeviceRequest(count=-1, capabilities=[['gpu']])]
+        container, errors = get_container(client, args.submissionid, docker_image, volumes, mem_limit=mem_limit,
+                                          nano_cpus=nano_cpus, device_requests=device_requests, runtime=runtime)
+
+        print("creating logfile")
+        # Create the logfile
+        log_filename = os.path.join(output_dir, args.submissionid + "_log.txt")
+        # Open log file first
+        open(log_filename, 'w').close()
+
+        # If the container doesn't exist, there are no logs to write out and
+        # no container to remove
+        if container is not None:
+            # Record resource usage while the container runs
+            stats_sampler = StatsSampler(container)
+            stats_sampler.start()
+            # Follow the logs until the container stops, uploading them as they grow
+            log_pump = LogPump(container, log_filename,
+                               upload=lambda: store_log_file(syn, log_filename, args.parentid, store=args.store))
+            log_pump.start()
+            log_pump.wait()
+            stats_sampler.stop()
+            telemetry = stats_sampler.write(os.path.join(output_dir, args.submissionid))
+            if telemetry["oom_killed"]:
+                print(f"Container was killed for exceeding its memory limit of {mem_limit}")
+            # Remove container and image after being done, the log pump only
+            # returns once the container has stopped
+            try:
+                container.remove()
+            except Exception as err:
+                print(f"Unable to remove container: {err}")
+
+        statinfo = os.stat(log_filename)
+
+        if statinfo.st_size == 0:
+            create_log_file(log_filename, log_text=errors)
+            store_log_file(syn, log_filename, args.parentid, store=args.store)
+
+        print("finished training")
+    finally:
+        # Try to remove the image, or leave it to the cache
+        if image_cache is None:
+            remove_docker_image(docker_image, client=client)
+        else:
+            image_cache.release(docker_image)
 
     output_folder = os.listdir(output_dir)
     print('output dir', output_folder)
@@ -220,6 +816,22 @@ def main(syn, args):
     # tar(output_dir, 'outputs.tar.gz')
 
 
+def main(syn, args):
+    """Run docker model"""
+    if args.status == "INVALID":
+        raise Exception("Docker image is invalid")
+
+    client = get_docker_client(args.synapse_config)
+
+    print(getpass.getuser())
+
+    image_cache = None
+    if getattr(args, "image_cache_quota", None):
+        image_cache = ImageCache(client, quota_bytes=parse_bytes(args.image_cache_quota),
+                                 state_file=getattr(args, "image_cache_state", None))
+    run_submission(syn, client, args, image_cache=image_cache)
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument("-s", "--submissionid", required=True,
@@ -237,6 +849,11 @@ if __name__ == '__main__':
     parser.add_argument("--parentid", required=True,
                         help="Parent Id of submitter directory")
     parser.add_argument("--status", required=True, help="Docker image status")
+    parser.add_argument("--image_cache_quota", default=None,
+                        help="Keep submission images up to this total size (e.g. 50g) "
+                             "instead of removing them after the run")
+    parser.add_argument("--image_cache_state", default=None,
+                        help="State file of the image cache")
     args = parser.parse_args()
     syn = synapseclient.Synapse(configPath=args.synapse_config)
     syn.login()
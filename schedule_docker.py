@@ -0,0 +1,210 @@
+"""Run a queue of docker submissions concurrently
+
+Submissions are admitted as soon as their CPU, memory and GPU requests fit in
+what is left of the host budgets, in queue order but letting a smaller
+submission overtake one that does not fit yet. Each one then runs through
+run_docker.run_submission, with its own output directory, so containers left
+running by an interrupted scheduler are reconnected to on the next run.
+
+The queue is a JSON list of submissions:
+
+    [{"submissionid": "9712345", "docker_repository": "docker.synapse.org/...",
+      "docker_digest": "sha256:...", "parentid": "syn123", "status": "VALIDATED",
+      "cpus": 4, "memory": "6g", "gpus": 1}, ...]
+
+where cpus, memory and gpus are optional and default to the command-line
+values.
+"""
+from __future__ import print_function
+import argparse
+import getpass
+import json
+import os
+import threading
+import traceback
+
+import synapseclient
+from docker.types import DeviceRequest
+from docker.utils import parse_bytes
+
+from run_docker import ImageCache, get_docker_client, run_submission
+
+
+class ResourceBudget:
+    """CPUs, memory and GPUs of the host shared by the running submissions"""
+
+    def __init__(self, cpus, memory, gpus=()):
+        self.cpus = cpus
+        self.memory = memory
+        self.gpus = list(gpus)
+        self.free_cpus = cpus
+        self.free_memory = memory
+        self.free_gpus = list(gpus)
+
+    def can_ever_fit(self, request):
+        return (request["cpus"] <= self.cpus and request["memory"] <= self.memory and
+                request["gpus"] <= len(self.gpus))
+
+    def fits(self, request):
+        return (request["cpus"] <= self.free_cpus and request["memory"] <= self.free_memory and
+                request["gpus"] <= len(self.free_gpus))
+
+    def acquire(self, request):
+        """Reserve a request that fits, returns the ids of the GPUs given to it"""
+        self.free_cpus -= request["cpus"]
+        self.free_memory -= request["memory"]
+        gpu_ids = self.free_gpus[:request["gpus"]]
+        del self.free_gpus[:request["gpus"]]
+        return gpu_ids
+
+    def release(self, request, gpu_ids):
+        self.free_cpus += request["cpus"]
+        self.free_memory += request["memory"]
+        self.free_gpus.extend(gpu_ids)
+
+
+def container_resources(request, gpu_ids):
+    """containers.run arguments enforcing a request"""
+    resources = {"mem_limit": request["memory"], "nano_cpus": int(request["cpus"] * 1e9)}
+    if gpu_ids:
+        resources["runtime"] = "nvidia"
+        resources["device_requests"] = [DeviceRequest(device_ids=[str(gpu) for gpu in gpu_ids],
+                                                      capabilities=[['gpu']])]
+    else:
+        resources["runtime"] = None
+        resources["device_requests"] = None
+    return resources
+
+
+def schedule(syn, client, submissions, budget, workdir, run=run_submission, image_cache=None, prefetch=2):
+    """Run every submission once it fits in the budget
+
+    `submissions` are argparse-like namespaces with the run_docker.py
+    arguments plus their cpus, memory (bytes) and gpus requests. With an
+    ImageCache, images are kept after their runs and the images of the next
+    `prefetch` queued submissions are pulled in the background. Returns
+    {submissionid: None or the error raised by the run}; submissions that
+    request more than the whole budget fail with a ValueError without
+    running, and the others still run.
+    """
+    condition = threading.Condition()
+    pending = list(submissions)
+    results = {}
+    threads = []
+
+    def run_one(args, request, gpu_ids):
+        output_dir = os.path.join(workdir, args.submissionid)
+        os.makedirs(output_dir, exist_ok=True)
+        try:
+            run(syn, client, args, output_dir=output_dir, image_cache=image_cache,
+                **container_resources(request, gpu_ids))
+            error = None
+        except Exception as err:
+            traceback.print_exc()
+            error = err
+        with condition:
+            results[args.submissionid] = error
+            budget.release(request, gpu_ids)
+            condition.notify_all()
+
+    for args in list(pending):
+        if not budget.can_ever_fit(vars(args)):
+            # would wait forever: failed, without holding up the rest of the queue
+            error = ValueError(f"Submission {args.submissionid} requests more than the total budget")
+            print(error)
+            results[args.submissionid] = error
+            pending.remove(args)
+
+    def prefetch_next():
+        if image_cache is not None and prefetch > 0:
+            image_cache.prefetch([args.docker_repository + "@" + args.docker_digest for args in pending[:prefetch]])
+
+    with condition:
+        while pending:
+            prefetch_next()
+            admitted = next((args for args in pending if budget.fits(vars(args))), None)
+            if admitted is None:
+                condition.wait()
+                continue
+            pending.remove(admitted)
+            request = vars(admitted)
+            gpu_ids = budget.acquire(request)
+            print(f"starting submission {admitted.submissionid} on GPUs {gpu_ids}")
+            thread = threading.Thread(target=run_one, args=(admitted, request, gpu_ids))
+            thread.start()
+            threads.append(thread)
+
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def read_queue(queue_file, input_dir, synapse_config, store, cpus, memory, gpus):
+    """Submissions of a queue file as run_docker.py argument namespaces"""
+    with open(queue_file) as fp:
+        queue = json.load(fp)
+    submissions = []
+    for entry in queue:
+        submissions.append(argparse.Namespace(
+            submissionid=str(entry["submissionid"]),
+            docker_repository=entry["docker_repository"],
+            docker_digest=entry["docker_digest"],
+            parentid=entry["parentid"],
+            status=entry.get("status", "VALIDATED"),
+            input_dir=entry.get("input_dir", input_dir),
+            synapse_config=synapse_config,
+            store=store,
+            cpus=float(entry.get("cpus", cpus)),
+            memory=parse_bytes(entry.get("memory", memory)),
+            gpus=int(entry.get("gpus", gpus)),
+        ))
+    return submissions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-q", "--queue", required=True,
+                        help="JSON list of the submissions to run")
+    parser.add_argument("-i", "--input_dir", required=True,
+                        help="Input Directory")
+    parser.add_argument("-c", "--synapse_config", required=True,
+                        help="credentials file")
+    parser.add_argument("-w", "--workdir", default=os.getcwd(),
+                        help="Directory holding one output directory per submission")
+    parser.add_argument("--store", action='store_true',
+                        help="to store logs")
+    parser.add_argument("--max_cpus", type=float, default=os.cpu_count(),
+                        help="CPUs shared by all running submissions")
+    parser.add_argument("--max_memory", default="24g",
+                        help="Memory shared by all running submissions")
+    parser.add_argument("--gpu_ids", default="",
+                        help="Comma separated ids of the GPUs shared by all running submissions")
+    parser.add_argument("--cpus", type=float, default=4,
+                        help="Default CPUs of a submission")
+    parser.add_argument("--memory", default="6g",
+                        help="Default memory limit of a submission")
+    parser.add_argument("--gpus", type=int, default=None,
+                        help="Default number of GPUs of a submission, 1 if --gpu_ids are given and 0 otherwise")
+    parser.add_argument("--image_cache_quota", default="0",
+                        help="Keep submission images up to this total size (e.g. 50g) and pre-pull queued ones")
+    parser.add_argument("--prefetch", type=int, default=2,
+                        help="Number of queued submissions whose images are pulled ahead of their runs")
+    parser.add_argument("--image_cache_state", default=None,
+                        help="State file of the image cache")
+    args = parser.parse_args()
+    syn = synapseclient.Synapse(configPath=args.synapse_config)
+    syn.login()
+    print(getpass.getuser())
+    gpu_ids = [gpu for gpu in args.gpu_ids.split(",") if gpu]
+    budget = ResourceBudget(args.max_cpus, parse_bytes(args.max_memory), gpu_ids)
+    # without GPUs to share, submissions run on CPUs only by default
+    gpus = args.gpus if args.gpus is not None else int(bool(gpu_ids))
+    submissions = read_queue(args.queue, args.input_dir, args.synapse_config, args.store,
+                             args.cpus, args.memory, gpus)
+    client = get_docker_client(args.synapse_config)
+    image_cache = ImageCache(client, quota_bytes=parse_bytes(args.image_cache_quota),
+                             state_file=args.image_cache_state)
+    results = schedule(syn, client, submissions, budget, args.workdir, image_cache=image_cache,
+                       prefetch=args.prefetch)
+    for submissionid, error in results.items():
+        print(submissionid, "OK" if error is None else f"FAILED: {error}")